@@ -17,18 +17,28 @@ from __future__ import division, print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# Live aiming: every request for / gets a fresh full size picture. Requests
+# that come close together (several people aiming, or a browser asking
+# twice) share one picture instead of each waiting their turn for the
+# camera: one taken within FRESHNESS seconds is handed out again, and a
+# request that comes while a picture is being taken waits for that one.
+#
+# python aim.py --dummy --benchmark 8 measures how many requests a second
+# are answered, and how long they take, with and without sharing.
+
+
+import argparse
 import os
 import os.path
 import shutil
-import StringIO
-import subprocess
 import sys
+import threading
 import time
+import timeit
 
 import cherrypy
-from cherrypy.lib import file_generator
 
-from PIL import Image
+import capture
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -37,31 +47,94 @@ IMAGE_WIDTH = 1600
 IMAGE_HEIGHT = 1200
 #IMAGE_WIDTH = 2592
 #IMAGE_HEIGHT = 1944
-
-
-def getRPiCameraImage():
-    command = "raspistill -mm average -vf -hf -w {} -h {} -ISO 200 -q 100 -t 1000 -e bmp -o -".format(IMAGE_WIDTH, IMAGE_HEIGHT)
-    im_data = StringIO.StringIO()
-    im_data.write(subprocess.check_output(command, shell=True))
-    im_data.seek(0)
-    im = Image.open(im_data)
-    im.load()
-    im_data.close()
-    return im
+IDLE_TIMEOUT = 30 # seconds without a request before the camera is closed
+FRESHNESS = 1.0 # seconds a picture is handed out again to other requests
+
+
+class SharedPicture:
+    """The latest picture from camera, shared between requests.
+
+    A request gets the last picture if it was taken less than `freshness`
+    seconds ago. Otherwise it takes a new one, unless another request is
+    already taking one, in which case it waits for that picture instead of
+    taking another. `requests` and `captures` count how much was shared.
+    """
+    def __init__(self, camera, freshness=FRESHNESS):
+        self.camera = camera
+        self.freshness = freshness
+        self.changed = threading.Condition()
+        self.picture = None # (jpeg data, timestamp)
+        self.taken = 0 # when self.picture was finished
+        self.capturing = False
+        self.attempts = 0 # pictures tried, whether or not they were taken
+        self.requests = 0
+        self.captures = 0
+
+    def get(self):
+        "A (jpeg data, timestamp) pair no older than freshness, or just taken."
+        with self.changed:
+            self.requests += 1
+            while self.capturing:
+                # wait for the picture being taken; if that fails, take one here
+                captures, attempt = self.captures, self.attempts + 1
+                while self.attempts < attempt:
+                    self.changed.wait()
+                if self.captures > captures:
+                    return self.picture
+            if self.picture is not None and time.time() - self.taken < self.freshness:
+                return self.picture
+            self.capturing = True
+        picture = None
+        try:
+            picture = self.camera.take_picture()
+        finally:
+            with self.changed:
+                if picture is not None:
+                    self.picture = picture
+                    self.taken = time.time()
+                    self.captures += 1
+                self.attempts += 1
+                self.capturing = False
+                self.changed.notify_all()
+        return picture
 
 
 class Root:
+    def __init__(self, picture):
+        self.picture = picture
+
     @cherrypy.expose
     def index(self):
-        im = getRPiCameraImage()
-        im_data = StringIO.StringIO()
-        im.save(im_data, format="JPEG")
-        im_data.seek(0)
+        # the camera already makes a jpeg; no need to decode and re-encode it
+        data, timestamp = self.picture.get()
         cherrypy.response.headers['Content-Type'] = "image/jpeg"
-        return file_generator(im_data)
+        return data
+
+
+def benchmark(get, clients, seconds, pause=0.05):
+    """(requests a second, mean and longest latency in seconds) with
+    `clients` threads calling get(), each pausing for `pause` seconds (like
+    a browser showing the picture) before asking again."""
+    latencies = [[] for i in range(clients)]
+    deadline = time.time() + seconds
+
+    def client(i):
+        while time.time() < deadline:
+            start = timeit.default_timer()
+            get()
+            latencies[i].append(timeit.default_timer() - start)
+            time.sleep(pause)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    everything = [l for ls in latencies for l in ls]
+    return (len(everything) / seconds, sum(everything) / len(everything), max(everything))
 
 
-def run(testing=False):
+def run(testing=False, backend=None):
     # Set up site-wide config first so we get a log if errors occur.
     cherrypy.config.update({'environment': 'production',
             'log.screen': testing})
@@ -70,8 +143,36 @@ def run(testing=False):
     if testing == True:
         cherrypy.engine.autoreload.subscribe()
 
-    cherrypy.quickstart(Root(), '/')
+    # While someone is aiming the camera it stays open between requests.
+    if backend is None:
+        backend = capture.PiCameraBackend((IMAGE_WIDTH, IMAGE_HEIGHT), flip=True)
+    with capture.CaptureEngine(backend, IDLE_TIMEOUT) as camera:
+        cherrypy.quickstart(Root(SharedPicture(camera)), '/')
 
 
 if __name__ == "__main__":
-    run(testing=True)
+    parser = argparse.ArgumentParser(description="Serve fresh pictures for aiming the camera.")
+    parser.add_argument("--dummy", action="store_true", help="use the dummy camera")
+    parser.add_argument("--benchmark", type=int, metavar="CLIENTS",
+                        help="measure requests from CLIENTS threads instead of serving")
+    parser.add_argument("--seconds", type=float, default=10, help="how long to benchmark for")
+    parser.add_argument("--pause", type=float, default=0.05,
+                        help="seconds each benchmark client waits between requests")
+    args = parser.parse_args()
+    backend = capture.DummyBackend((IMAGE_WIDTH, IMAGE_HEIGHT)) if args.dummy else None
+    if args.benchmark:
+        if backend is None:
+            backend = capture.PiCameraBackend((IMAGE_WIDTH, IMAGE_HEIGHT), flip=True)
+        with capture.CaptureEngine(backend, IDLE_TIMEOUT) as camera:
+            for name, get, shared in (("every request takes a picture", camera.take_picture, None),
+                                      ("shared in-flight pictures", None, 0),
+                                      ("shared within {:g}s".format(FRESHNESS), None, FRESHNESS)):
+                if shared is not None:
+                    shared = SharedPicture(camera, shared)
+                    get = shared.get
+                rate, mean, longest = benchmark(get, args.benchmark, args.seconds, args.pause)
+                print("{:32} {:7.1f} requests/s  latency mean {:6.1f} ms  max {:6.1f} ms{}".format(
+                    name, rate, mean * 1000, longest * 1000,
+                    "  ({} pictures)".format(shared.captures) if shared else ""))
+    else:
+        run(testing=True, backend=backend)
@@ -17,192 +17,242 @@ from __future__ import division, print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import copy
+import argparse
 import datetime
-import io
 import multiprocessing
 import os
-import random
-import subprocess
 import sys
 import time
+import timeit
+import traceback
 
-import numpy
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-import picamera
-
-from PIL import Image
+import capture
+import jpeg
+import light
+import metrics
+import storage
 
 
 _current_directory = os.path.dirname(os.path.abspath(__file__))
 _event_directory =  _current_directory + "/events"
 _preview_directory = _current_directory + "/previews"
+_index_path = _current_directory + "/captures.db"
 _image_width = 2592
 _image_height = 1944
 _preview_width = _image_width // 3
 _preview_heigh = _image_height // 3
 _heartbeat = 10
-_darkness_cutoff = 40000000
-_darkness_sleeptime = 10 # time in minutes
-
-
-
-class RPiCamera:
-    def __init__(self, image_size=(_image_width, _image_height)):
-        self.image_size = image_size
-        self.image_counter = 0
-        self.start_time = datetime.datetime.now()
-
-    def take_picture(self):
-        # Create the in-memory stream
-        stream = io.BytesIO()
-        with picamera.PiCamera() as camera:
-            camera.resolution = self.image_size
-            camera.meter_mode = 'average'
-            camera.ISO = 200
-            camera.start_preview()
-            time.sleep(2)
-            camera.capture(stream, format='jpeg')
-        # "Rewind" the stream to the beginning so we can read its content
-        stream.seek(0)
-        image = Image.open(stream)
-        timestamp = datetime.datetime.now()
-        self.image_counter += 1
-        return (image, timestamp)
-
-
-
-class RPiCamera2:
-    def __init__(self, image_size=(_image_width, _image_height)):
-        self.image_size = image_size
-        self.image_counter = 0
-        self.start_time = datetime.datetime.now()
-        # set up the camera (with initial values, run preview, etc.)
-        self.camera = self.start()
-
-
-    def start(self):
-        camera = picamera.PiCamera()
-        camera.resolution = self.image_size
-        camera.meter_mode = 'average'
-        camera.ISO = 200
-        camera.vflip = True
-        camera.hflip = True
-        # Need to "warm up" the camera for a few seconds before starting to take any picutres
-        # to ensure that it has an accurate exposure reading.
-        camera.start_preview()
-        time.sleep(10)
-        self.running = True
-        return camera
-
-
-    def stop(self):
-        # When the camera isn't going to be used for a while, turn it off to save power.
-        # (for example when it's too dark outside)
-        self.camera.stop_preview()
-        self.camera.close()
-        self.running = False
-
-
-    def take_picture(self):
-        if not self.running: self.start()
-        # Create the in-memory stream
-        stream = io.BytesIO()
-        self.camera.capture(stream, format='jpeg')
-        # "Rewind" the stream to the beginning so we can read its content
-        stream.seek(0)
-        image = Image.open(stream)
-        timestamp = datetime.datetime.now()
-        self.image_counter += 1
-        return (image, timestamp)
-
-
-
-class DummyCamera:
-    def __init__(self, image_size=(_image_width, _image_height)):
-        self.image_size = image_size
-        self.image_counter = 0
-        self.start_time = datetime.datetime.now()
-        self.running = False
-
-    def start(self):
-        self.running = True
-        time.sleep(10)
-
-    def stop(self):
-        self.running = False
-
-    def take_picture(self):
-        # start up the camera if it is not currently running
-        if not self.running: self.start()
-        color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
-        image = Image.new('RGB', self.image_size, color)
-        timestamp = datetime.datetime.now()
-        self.image_counter += 1
-        time.sleep(2)
-        return (image, timestamp)
-
-
-def brightness(image):
-    m = numpy.asarray(image)
-    return numpy.sum(m)
-
-
-def save_image(image, image_counter, timestamp):
-    outfile = "{:05d}_{}.jpg".format(image_counter,
-                timestamp.strftime("%Y%b%d_%H%M%S"))
-    preview = image.resize((_preview_width,_preview_heigh))
-    preview.save(os.path.join(_preview_directory, outfile))
-    image.save(os.path.join(_event_directory, outfile), quality=90)
-
-
-def free_space():
-    "Free disk space in gigabytes."
-    s = os.statvfs('/')
-    return (s.f_bavail * s.f_frsize) / 1.0e9
-
-
-def run(testing=False):
-    if not os.path.exists(_event_directory):
-        os.makedirs(_event_directory)
-    if not os.path.exists(_preview_directory):
-        os.makedirs(_preview_directory)
+_darkness_min_sleeptime = 60 # seconds; doubles each time it is still too dark
+_darkness_max_sleeptime = 600
+_save_slots = 8 # pictures that can be waiting to be saved
+_save_workers = 2
+_burst_frames = 0 # take this many pictures at a time from the video port (0 for one still)
+
+
+
+def picture_name(image_counter, timestamp):
+    return "{:05d}_{}.jpg".format(image_counter, timestamp.strftime("%Y%b%d_%H%M%S"))
 
-    Camera = RPiCamera2()
-    #Camera = DummyCamera()
 
-    too_dark = False
+def save_image(data, image_counter, timestamp):
+    "Save the picture and its preview; returns the (picture, preview) paths."
+    outfile = picture_name(image_counter, timestamp)
+    paths = (os.path.join(storage.shard_directory(_event_directory, timestamp), outfile),
+             os.path.join(storage.shard_directory(_preview_directory, timestamp), outfile))
+    jpeg.save(data, paths[0], paths[1], (_preview_width,_preview_heigh))
+    return paths
 
-    image, timestamp = Camera.take_picture()
 
+def _save_worker(jobs, written, failed):
     while True:
-        running_time = str(timestamp - Camera.start_time).split('.')[0]
-        print("\rtime: {} images: {}".format(running_time, Camera.image_counter), end="")
-        sys.stdout.flush()
-
-        if Camera.image_counter % _heartbeat == 0 or too_dark:
-            light_level = brightness(image)
-            if light_level < _darkness_cutoff:
-                too_dark = True
-                Camera.stop()
-                print(" * too dark ({}); sleeping for {} minutes".format(light_level, _darkness_sleeptime), end="")
-                sys.stdout.flush()
-                time.sleep(_darkness_sleeptime * 60)
-            else:
-                too_dark = False
-                print(" *", end="")
-                sys.stdout.flush()
-            if free_space() < 0.5:
-                print("\n\n**** quitting: no disk space ****\n\n")
-                break
+        job = jobs.get()
+        if job is None:
+            break
+        data, image_counter, timestamp = job
+        start = timeit.default_timer()
+        try:
+            paths = save_image(data, image_counter, timestamp)
+        except Exception:
+            # one picture that can't be saved mustn't stop the rest
+            traceback.print_exc()
+            failed.put(picture_name(image_counter, timestamp))
+            continue
+        written.put((paths, timeit.default_timer() - start))
+
+
+class SaveWorkers:
+    """Long running processes that save pictures for the capture loop.
+
+    Pictures (jpeg bytes) are handed over through a queue holding at most
+    `slots` pictures waiting to be saved, so nothing is forked per picture
+    and memory use stays bounded whatever size the pictures are. When the
+    queue is full, save() blocks until a worker takes one. The paths of
+    saved pictures, and how long they took to save, come back through
+    written(); the names of any that couldn't be saved through failures().
+    """
+    def __init__(self, slots=_save_slots, workers=_save_workers):
+        self.jobs = multiprocessing.Queue(slots)
+        self.written_paths = multiprocessing.Queue()
+        self.failed_names = multiprocessing.Queue()
+        self.failed = 0
+        self.processes = [multiprocessing.Process(target=_save_worker,
+                                                  args=(self.jobs, self.written_paths,
+                                                        self.failed_names))
+                          for x in range(workers)]
+        for p in self.processes:
+            p.daemon = True
+            p.start()
+
+    def save(self, data, image_counter, timestamp):
+        self.jobs.put((data, image_counter, timestamp))
+
+    def written(self):
+        "((picture, preview) paths, seconds) of pictures saved since the last call."
+        paths = []
+        while True:
+            try:
+                paths.append(self.written_paths.get_nowait())
+            except queue.Empty:
+                return paths
+
+    def failures(self):
+        "Names of pictures that couldn't be saved since the last call."
+        names = []
+        while True:
+            try:
+                names.append(self.failed_names.get_nowait())
+            except queue.Empty:
+                self.failed += len(names)
+                return names
+
+    def close(self):
+        "Finish saving every picture handed over so far."
+        for p in self.processes:
+            self.jobs.put(None)
+        for p in self.processes:
+            p.join()
+
+
+def run(testing=False, backend=None, burst_frames=_burst_frames, engine=None):
+    if not os.path.exists(_event_directory):
+        os.makedirs(_event_directory)
+    if not os.path.exists(_preview_directory):
+        os.makedirs(_preview_directory)
 
-        save_process = multiprocessing.Process(target=save_image, args=(copy.copy(image), Camera.image_counter, timestamp))
-        save_process.start()
-        image, timestamp = Camera.take_picture()
-        save_process.join()
+    if engine is None:
+        if backend is None:
+            backend = capture.PiCameraBackend(flip=True)
+        engine = capture.CaptureEngine(backend)
+    Camera = engine
+
+    darkness = light.DarknessMonitor(_darkness_min_sleeptime, _darkness_max_sleeptime)
+    timings = metrics.Metrics("camera", ("capture", "brightness", "queue", "save", "sleep"),
+                              ("images", "failed"))
+
+    # old pictures are deleted to make room rather than stopping when the disk fills up
+    index = storage.CaptureIndex(_index_path)
+    disk = storage.StorageManager({storage.PICTURE: _event_directory,
+                                   storage.PREVIEW: _preview_directory}, index=index)
+    saving = {} # picture path -> (timestamp, brightness), until it has been saved
+
+    def take_picture():
+        with timings.timed("capture"):
+            return Camera.take_picture()
+
+    def save(data, image_counter, timestamp, brightness=None):
+        # waiting here means the save workers are falling behind
+        with timings.timed("queue"):
+            disk.make_room(len(data))
+            save_workers.save(data, image_counter, timestamp)
+        timings.increment("images")
+        saving[picture_name(image_counter, timestamp)] = (timestamp, brightness)
+
+    def saved():
+        for (picture_path, preview_path), seconds in save_workers.written():
+            timings.observe("save", seconds)
+            disk.record(picture_path, storage.PICTURE)
+            disk.record(preview_path, storage.PREVIEW)
+            picture_timestamp, brightness = saving.pop(os.path.basename(picture_path))
+            index.add(picture_path, picture_timestamp, disk.sizes[picture_path][1],
+                      brightness=brightness, preview=preview_path)
+        for name in save_workers.failures():
+            timings.increment("failed")
+            saving.pop(name)
+
+    # the camera is closed at the end, unless it is shared with others still using it
+    with Camera:
+        data, timestamp = take_picture()
+        save_workers = SaveWorkers()
+        unmetered = 0 # pictures taken since the light was last metered
+
+        try:
+            while True:
+                # uptime by the engine's clock: replayed and synthetic frames
+                # carry timestamps of their own
+                running_time = str(datetime.datetime.now() - Camera.start_time).split('.')[0]
+                print("\rtime: {} images: {} deleted: {} failed: {}".format(
+                    running_time, Camera.image_counter, disk.deleted, save_workers.failed), end="")
+                sys.stdout.flush()
 
-        print("\r{:78}".format(""), end="\r")
+                light_level = None
+                if unmetered >= _heartbeat or darkness.too_dark:
+                    unmetered = 0
+                    with timings.timed("brightness"):
+                        light_level = light.level(data)
+                    sleep_time = darkness.check(light_level)
+                    if sleep_time:
+                        Camera.stop()
+                        index.flush()
+                        print(" * too dark ({:.1f}); sleeping for {} seconds".format(light_level, sleep_time), end="")
+                        sys.stdout.flush()
+                        with timings.timed("sleep"):
+                            time.sleep(sleep_time)
+                    else:
+                        print(" *", end="")
+                        sys.stdout.flush()
+
+                # saving happens in the worker processes while the next pictures are taken
+                save(data, Camera.image_counter, timestamp, light_level)
+                if burst_frames:
+                    # All but the last picture of the burst are saved as they come
+                    # in; the last one goes round the loop like a single picture.
+                    capture_start = timeit.default_timer()
+                    for x, (data, timestamp) in enumerate(Camera.burst(burst_frames)):
+                        timings.observe("capture", timeit.default_timer() - capture_start)
+                        if x < burst_frames - 1:
+                            save(data, Camera.image_counter, timestamp)
+                        capture_start = timeit.default_timer()
+                    print(" burst: {:.1f} fps".format(Camera.burst_fps), end="")
+                    sys.stdout.flush()
+                else:
+                    data, timestamp = take_picture()
+                unmetered += burst_frames or 1
+                saved()
+
+                print("\r{:78}".format(""), end="\r")
+        finally:
+            save_workers.close()
+            saved()
+            index.close()
 
 
 if __name__ == "__main__":
-    run(testing=True)
+    parser = argparse.ArgumentParser(description="Take pictures, sleeping while it is dark.")
+    parser.add_argument("--burst", type=int, default=_burst_frames,
+                        help="pictures to take at a time from the video port (0 for one still)")
+    parser.add_argument("--dummy", action="store_true",
+                        help="use made up pictures instead of the camera")
+    parser.add_argument("--scene", choices=sorted(capture.SCENES),
+                        help="use a synthetic scene instead of the camera")
+    args = parser.parse_args()
+    backend = None
+    if args.dummy:
+        backend = capture.DummyBackend()
+    elif args.scene:
+        backend = capture.SyntheticBackend(**capture.SCENES[args.scene])
+    run(testing=True, backend=backend, burst_frames=args.burst)
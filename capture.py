@@ -0,0 +1,868 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Camera backends that stay open between frames, and the CaptureEngine that
+# shares one of them between everything that wants pictures. Every backend
+# has the same methods:
+#
+#   start()              open the camera
+#   stop()               close it again
+#   frames(size, jpeg)   generator of (luma, timestamp, data) triples, where
+#                        luma is a size[1] x size[0] uint8 numpy array and
+#                        data is the full resolution picture as jpeg bytes
+#                        if jpeg is True (None otherwise)
+#   still(annotation)    a full resolution (jpeg_bytes, timestamp) pair, with
+#                        the annotation text drawn on it (and only on it) if
+#                        the camera can
+#   burst(count)         generator of count full resolution (jpeg_bytes,
+#                        timestamp) pairs, taken as fast as the camera can
+#   preview(size, quality)
+#                        a (jpeg_bytes, timestamp) pair at size, resized by
+#                        the camera on a video port of its own
+#   annotate(text)       draw text on the pictures and video from now on
+#   start_recording(path), wait_recording(seconds), stop_recording()
+#                        record h264 video to path alongside everything else
+#
+# so the picamera backend can be swapped for a dummy, a directory of recorded
+# pictures or a synthetic scene when there is no camera around.
+
+
+import collections
+import datetime
+import io
+import math
+import os
+import random
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+from PIL import Image, ImageChops
+
+import jpeg
+import writer
+
+try:
+    import picamera
+except ImportError:
+    picamera = None
+
+
+_image_width = 2592
+_image_height = 1944
+_detection_size = (160, 120)
+# splitter ports of the camera's video port, so the detection stream, its
+# jpegs, recordings and previews can all run at once
+_detection_port = 0
+_jpeg_port = 1
+_recording_port = 2
+_preview_port = 3
+IDLE_TIMEOUT = 60 # seconds without a picture before the camera is closed
+
+
+def _round_up(x, n):
+    return (x + n - 1) // n * n
+
+
+def luma_from_jpeg(data, size=_detection_size):
+    "Decode jpeg data at the smallest scale that is still at least size."
+    im = Image.open(io.BytesIO(data))
+    im.draft('L', size)
+    return np.asarray(im.convert('L').resize(size))
+
+
+class PiCameraBackend:
+    live = True # frames come in real time, whether or not anyone keeps up
+
+    def __init__(self, image_size=(_image_width, _image_height), framerate=5,
+                 flip=False, settle_time=2):
+        self.image_size = image_size
+        self.framerate = framerate
+        self.flip = flip
+        self.settle_time = settle_time
+        self.camera = None
+        self.recording = False
+
+    def start(self):
+        camera = picamera.PiCamera()
+        camera.resolution = self.image_size
+        camera.framerate = self.framerate
+        camera.meter_mode = 'average'
+        camera.ISO = 200
+        camera.vflip = self.flip
+        camera.hflip = self.flip
+        camera.annotate_background = True
+        # Give the camera a couple of seconds to settle on an exposure; this
+        # only happens once, not for every picture.
+        camera.start_preview()
+        time.sleep(self.settle_time)
+        self.camera = camera
+
+    def stop(self):
+        self.camera.stop_preview()
+        self.camera.close()
+        self.camera = None
+
+    def frames(self, size=_detection_size, jpeg=False):
+        # Unencoded YUV captures, resized by the GPU, start with the full Y
+        # (luma) plane, padded out to a multiple of 32 pixels wide and 16
+        # pixels high. With jpeg, full resolution jpegs are captured alongside
+        # on a second splitter port, so the luma is never decoded from them.
+        width, height = size
+        padded_width, padded_height = _round_up(width, 32), _round_up(height, 16)
+        jpegs = _JpegPort(self.camera, _jpeg_port, self.framerate) if jpeg else None
+        stream = io.BytesIO()
+        try:
+            for _ in self.camera.capture_continuous(stream, format='yuv', resize=size,
+                                                    use_video_port=True,
+                                                    splitter_port=_detection_port):
+                timestamp = datetime.datetime.now()
+                y = np.frombuffer(stream.getvalue(), dtype=np.uint8,
+                                  count=padded_width * padded_height)
+                luma = y.reshape((padded_height, padded_width))[:height, :width].copy()
+                stream.seek(0)
+                stream.truncate()
+                yield (luma, timestamp, jpegs.next_jpeg() if jpegs else None)
+        finally:
+            if jpegs is not None:
+                jpegs.stop()
+
+    def burst(self, count):
+        # Continuous capture from the video port doesn't stop to switch modes
+        # between pictures, so it runs at close to the camera's frame rate.
+        stream = io.BytesIO()
+        taken = 0
+        for _ in self.camera.capture_continuous(stream, format='jpeg', use_video_port=True):
+            timestamp = datetime.datetime.now()
+            data = stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+            yield (data, timestamp)
+            taken += 1
+            if taken == count:
+                break
+
+    def still(self, annotation=None):
+        stream = io.BytesIO()
+        previous = self.camera.annotate_text
+        if annotation is not None:
+            self.camera.annotate_text = annotation
+        try:
+            # a still port capture would drop frames from a recording
+            self.camera.capture(stream, format='jpeg', use_video_port=self.recording)
+        finally:
+            # the annotation is for this picture only
+            self.camera.annotate_text = previous
+        return (stream.getvalue(), datetime.datetime.now())
+
+    def preview(self, size, quality=75):
+        stream = io.BytesIO()
+        self.camera.capture(stream, format='jpeg', use_video_port=True, resize=size,
+                            quality=quality, splitter_port=_preview_port)
+        return (stream.getvalue(), datetime.datetime.now())
+
+    def annotate(self, text):
+        self.camera.annotate_text = text
+
+    def start_recording(self, path):
+        self.camera.start_recording(path, format='h264', splitter_port=_recording_port)
+        self.recording = True
+
+    def wait_recording(self, seconds):
+        self.camera.wait_recording(seconds, splitter_port=_recording_port)
+
+    def stop_recording(self):
+        self.recording = False
+        self.camera.stop_recording(splitter_port=_recording_port)
+
+
+class _JpegPort:
+    """Full resolution jpegs captured continuously on a splitter port of
+    their own, in a thread, for the frames of a detection stream."""
+    def __init__(self, camera, splitter_port, framerate):
+        self.changed = threading.Condition()
+        self.data = None
+        self.new = False
+        self.running = True
+        self.wait_time = 2 / framerate
+        self.thread = threading.Thread(target=self._capture, args=(camera, splitter_port))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _capture(self, camera, splitter_port):
+        stream = io.BytesIO()
+        try:
+            for _ in camera.capture_continuous(stream, format='jpeg', use_video_port=True,
+                                               splitter_port=splitter_port):
+                with self.changed:
+                    self.data = stream.getvalue()
+                    self.new = True
+                    self.changed.notify_all()
+                stream.seek(0)
+                stream.truncate()
+                if not self.running:
+                    break
+        except Exception:
+            traceback.print_exc()
+
+    def next_jpeg(self):
+        """The jpeg captured since the last call, waiting up to two frames
+        for it; None if none came."""
+        with self.changed:
+            if not self.new:
+                self.changed.wait(self.wait_time)
+            if not self.new:
+                return None
+            self.new = False
+            return self.data
+
+    def stop(self):
+        self.running = False
+        self.thread.join(5)
+
+
+class _NoCamera:
+    "Annotation and recording for the backends without a real camera."
+    live = False # frames are made as they are asked for
+
+    def annotate(self, text):
+        pass
+
+    def start_recording(self, path):
+        # nothing is recorded, but the file is there
+        open(path, 'wb').close()
+
+    def wait_recording(self, seconds):
+        time.sleep(seconds)
+
+    def stop_recording(self):
+        pass
+
+    def preview(self, size, quality=75):
+        data, timestamp = self.still()
+        stream = io.BytesIO()
+        jpeg.preview(data, size).save(stream, format='JPEG', quality=quality)
+        return (stream.getvalue(), timestamp)
+
+
+class DummyBackend(_NoCamera):
+    "Random solid colour pictures, as fast as they can be made."
+    def __init__(self, image_size=(_image_width, _image_height)):
+        self.image_size = image_size
+        self.color = (0, 0, 0)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def frames(self, size=_detection_size, jpeg=False):
+        while True:
+            self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
+            luma = Image.new('RGB', size, self.color).convert('L')
+            data = self.still()[0] if jpeg else None
+            yield (np.asarray(luma), datetime.datetime.now(), data)
+
+    def burst(self, count):
+        for x in range(count):
+            self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
+            yield self.still()
+
+    def still(self, annotation=None):
+        stream = io.BytesIO()
+        Image.new('RGB', self.image_size, self.color).save(stream, format='JPEG')
+        return (stream.getvalue(), datetime.datetime.now())
+
+
+class ReplayBackend(_NoCamera):
+    "Plays back a directory of jpeg pictures as if they came from the camera."
+    def __init__(self, directory, loop=False):
+        self.directory = directory
+        self.loop = loop
+        self.current = None
+
+    def start(self):
+        self.paths = sorted(os.path.join(self.directory, f)
+                            for f in os.listdir(self.directory)
+                            if os.path.splitext(f)[-1].lower() in (".jpg", ".jpeg"))
+
+    def stop(self):
+        pass
+
+    def frames(self, size=_detection_size, jpeg=False):
+        while True:
+            for path in self.paths:
+                self.current = path
+                with open(path, 'rb') as f:
+                    data = f.read()
+                yield (luma_from_jpeg(data, size), datetime.datetime.now(),
+                       data if jpeg else None)
+            if not self.loop:
+                break
+
+    def burst(self, count):
+        start = self.paths.index(self.current) + 1 if self.current else 0
+        for x in range(count):
+            if start + x >= len(self.paths) and not self.loop:
+                break
+            self.current = self.paths[(start + x) % len(self.paths)]
+            yield self.still()
+
+    def still(self, annotation=None):
+        if self.current is None:
+            self.current = self.paths[0]
+        with open(self.current, 'rb') as f:
+            return (f.read(), datetime.datetime.now())
+
+
+MovingBlob = collections.namedtuple("MovingBlob", "size speed y shade every")
+MovingBlob.__new__.__defaults__ = (None,)
+MovingBlob.__doc__ = """A square crossing the picture from left to right:
+size is its side as a fraction of the picture width, speed is in picture
+widths per second, y is the height of its centre as a fraction of the
+picture height and shade its grey level (0-255). It sets off again every
+`every` seconds, or as soon as it is out of the picture if that is None."""
+
+# ready made scenes for SyntheticBackend(**SCENES[name])
+SCENES = {
+    "static": {},
+    "noise": {"noise": 8},
+    "ramp": {"noise": 2, "light_ramp": (1.0, 0.1, 600)},
+    "visitors": {"noise": 2, "blobs": (MovingBlob(0.04, 0.1, 0.5, 20, 30),
+                                       MovingBlob(0.02, 0.25, 0.3, 230, 45))},
+    "daynight": {"noise": 2, "blobs": (MovingBlob(0.04, 0.1, 0.5, 20, 30),),
+                 "day_night": (600, 300, 60)},
+}
+_night_level = 0.01 # brightness at night, well below light.DARK_LEVEL
+_noise_frames = 8
+
+
+class SyntheticBackend(_NoCamera):
+    """Made up scenes, rendered as fast as they can be and the same every
+    time for the same seed.
+
+    A still background texture, darkened or brightened by a light ramp
+    (from_level, to_level, seconds) and a day and night cycle (day_seconds,
+    night_seconds, transition_seconds), with MovingBlobs on top and noise of
+    the given standard deviation. Nothing sleeps: frame n is stamped
+    n / framerate seconds after start, and moves on that clock.
+    """
+    def __init__(self, image_size=(_image_width, _image_height), framerate=5, seed=0, noise=0,
+                 blobs=(), light_ramp=None, day_night=None,
+                 start=datetime.datetime(2015, 6, 1, 12, 0)):
+        self.image_size = image_size
+        self.framerate = framerate
+        self.seed = seed
+        self.noise = noise
+        self.blobs = blobs
+        self.light_ramp = light_ramp
+        self.day_night = day_night
+        self.start_time = start
+        self.frame = 0
+        self._backgrounds = {}
+        self._noise = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def _background(self, size):
+        if size not in self._backgrounds:
+            # smooth blotches, the same at every size
+            rng = np.random.RandomState(self.seed)
+            coarse = rng.randint(60, 200, (12, 16)).astype(np.uint8)
+            self._backgrounds[size] = Image.fromarray(coarse).resize(size, Image.BILINEAR)
+        return self._backgrounds[size]
+
+    def _noise_field(self, frame, size):
+        # A few fields of noise (around 128) made up front; each frame gets
+        # one of them, shifted by a different amount.
+        if size not in self._noise:
+            rng = np.random.RandomState(self.seed + 1)
+            self._noise[size] = [Image.fromarray(np.clip(rng.normal(128, self.noise, (size[1], size[0])),
+                                                         0, 255).astype(np.uint8))
+                                 for x in range(_noise_frames)]
+        field = self._noise[size][frame % _noise_frames]
+        return ImageChops.offset(field, (frame * 37) % size[0], (frame * 17) % size[1])
+
+    def brightness(self, seconds):
+        "Brightness multiplier at seconds after the start."
+        level = 1.0
+        if self.light_ramp is not None:
+            begin, end, duration = self.light_ramp
+            level *= begin + (end - begin) * min(seconds / duration, 1.0)
+        if self.day_night is not None:
+            day, night, transition = self.day_night
+            t = seconds % (day + night)
+            if t < day - transition:
+                f = 1.0
+            elif t < day:
+                f = 0.5 + 0.5 * math.cos(math.pi * (t - day + transition) / transition)
+            elif t < day + night - transition:
+                f = 0.0
+            else:
+                f = 0.5 - 0.5 * math.cos(math.pi * (t - day - night + transition) / transition)
+            level *= _night_level + (1 - _night_level) * f
+        return level
+
+    def render(self, frame, size):
+        "Frame number frame of the scene, as a size greyscale image."
+        seconds = frame / self.framerate
+        im = self._background(size).copy()
+        width, height = size
+        for blob in self.blobs:
+            side = max(int(blob.size * width), 1)
+            travel = blob.speed * width * (seconds % blob.every if blob.every else seconds)
+            x = int(travel % (width + side) if blob.every is None else travel) - side
+            if x >= width:
+                continue
+            y = int(blob.y * height) - side // 2
+            im.paste(blob.shade, (x, y, x + side, y + side))
+        level = self.brightness(seconds)
+        if level != 1.0:
+            im = im.point([min(int(v * level + 0.5), 255) for v in range(256)])
+        if self.noise:
+            im = ImageChops.add(im, self._noise_field(frame, size), 1.0, -128)
+        return im
+
+    def _jpeg(self, frame):
+        stream = io.BytesIO()
+        self.render(frame, self.image_size).convert('RGB').save(stream, format='JPEG')
+        return stream.getvalue()
+
+    def _timestamp(self, frame):
+        return self.start_time + datetime.timedelta(seconds=frame / self.framerate)
+
+    def frames(self, size=_detection_size, jpeg=False):
+        while True:
+            self.frame += 1
+            if jpeg:
+                data = self._jpeg(self.frame)
+                luma = luma_from_jpeg(data, size)
+            else:
+                data = None
+                luma = np.asarray(self.render(self.frame, size))
+            yield (luma, self._timestamp(self.frame), data)
+
+    def burst(self, count):
+        for x in range(count):
+            self.frame += 1
+            yield (self._jpeg(self.frame), self._timestamp(self.frame))
+
+    def still(self, annotation=None):
+        self.frame += 1
+        return (self._jpeg(self.frame), self._timestamp(self.frame))
+
+
+class Frame:
+    """One frame from the camera: the full resolution jpeg (if the stream
+    was making them) and the low resolution luma. Other sizes and previews
+    are made from these when first asked for, once however many consumers
+    ask."""
+    def __init__(self, number, timestamp, data=None, luma=None, luma_size=_detection_size):
+        self.number = number
+        self.timestamp = timestamp
+        self.data = data
+        self.lock = threading.Lock()
+        self.cache = {}
+        if luma is not None:
+            self.cache[("luma", luma_size)] = luma
+        self._luma = (luma_size, luma)
+
+    def _get(self, key, make):
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = make()
+            return self.cache[key]
+
+    def luma(self, size=_detection_size):
+        "size[1] x size[0] uint8 luma array."
+        if self.data is not None:
+            return self._get(("luma", size), lambda: luma_from_jpeg(self.data, size))
+        luma = self._luma[1]
+        return self._get(("luma", size),
+                         lambda: np.asarray(Image.fromarray(luma).resize(size, Image.BILINEAR)))
+
+    def preview(self, size, quality=75):
+        "Jpeg bytes of a size preview (needs a jpeg stream)."
+        def make():
+            stream = io.BytesIO()
+            jpeg.preview(self.data, size).save(stream, format='JPEG', quality=quality)
+            return stream.getvalue()
+        return self._get(("preview", size, quality), make)
+
+
+class Subscription:
+    """A consumer's share of a CaptureEngine's frames.
+
+    Frames wait in a queue of at most maxsize; when it is full the engine
+    either waits for the consumer (writer.BLOCK) or throws the oldest frame
+    away (writer.DROP_OLDEST). Only every `every`th frame is queued. Use it
+    with `with`, which starts and ends the subscription. frames() gives the
+    same (luma, timestamp, data) triples as a backend's frames(), with data
+    only if keep_jpeg.
+    """
+    def __init__(self, engine, size=_detection_size, keep_jpeg=False, maxsize=2, policy=None,
+                 every=1):
+        if policy is None:
+            # don't lose frames that are only made as fast as they are used
+            policy = writer.DROP_OLDEST if engine.backend.live else writer.BLOCK
+        self.engine = engine
+        self.size = size
+        self.keep_jpeg = keep_jpeg
+        self.policy = policy
+        self.every = every
+        self.queue = queue.Queue(maxsize)
+        self.frame_counter = 0
+        self.dropped = 0
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.engine._subscribe(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.engine._unsubscribe(self)
+
+    def _put(self, frame):
+        if frame is not None:
+            if frame.number % self.every != 0 or (self.keep_jpeg and frame.data is None):
+                return
+        if self.policy == writer.BLOCK:
+            # wait for room, unless the consumer has gone
+            while self in self.engine.subscriptions:
+                try:
+                    self.queue.put(frame, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            if frame is not None:
+                return
+        # frames to a DROP_OLDEST subscriber, and the end marker to one that
+        # has been closed, never wait
+        while True:
+            try:
+                self.queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def next_frame(self, timeout=None):
+        "The next Frame, or None once the stream has ended."
+        try:
+            frame = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if frame is None:
+            # leave the end marker for anyone else waiting
+            self.queue.put(None)
+            return None
+        self.frame_counter += 1
+        return frame
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield (frame.luma(self.size), frame.timestamp, frame.data if self.keep_jpeg else None)
+
+    def fps(self):
+        "Average frames per second since the subscription started."
+        elapsed = time.time() - self.start_time
+        return self.frame_counter / elapsed if elapsed > 0 else 0.0
+
+
+class CaptureEngine:
+    """Owns the camera and shares it between everything that wants pictures.
+
+    While anyone is subscribed, one thread streams frames from the backend
+    (full resolution jpegs from the video port if any subscriber wants them,
+    luma only otherwise) and hands every frame to every subscriber. Single
+    pictures come from that stream while it runs, and from the still port
+    otherwise. Video can be recorded at the same time.
+
+    The camera is opened (and left to settle) when first needed and then
+    kept open, so later pictures only cost the capture itself. Once it has
+    been idle for idle_timeout seconds, with no subscribers and no
+    recording, it is closed to save power, and opened again when needed.
+
+    Every `with` block using the engine counts as a user; it closes when the
+    last one ends, so scripts sharing an engine don't close it on each other.
+    """
+    def __init__(self, backend, idle_timeout=IDLE_TIMEOUT):
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.image_counter = 0
+        self.frame_counter = 0
+        self.start_time = datetime.datetime.now()
+        self.running = False
+        self.recording = None
+        self.streaming = False
+        self.stream_ended = False
+        self.subscriptions = []
+        self.users = 0
+        self.last_used = 0
+        self.burst_fps = 0.0
+        self.bursting = 0 # bursts taking pictures without a stream
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.closed = threading.Event()
+        self.threads = [threading.Thread(target=self._watch), threading.Thread(target=self._stream)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def __enter__(self):
+        with self.lock:
+            self.users += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.users -= 1
+            last = self.users <= 0
+        if last:
+            self.close()
+
+    def _watch(self):
+        while not self.closed.wait(max(self.idle_timeout / 4, 0.1)):
+            with self.lock:
+                if (self.running and not self.subscriptions and self.recording is None
+                        and not self.bursting and time.time() - self.last_used > self.idle_timeout):
+                    self._stop()
+
+    def _start(self):
+        if not self.running:
+            self.backend.start()
+            self.running = True
+
+    def _stop(self):
+        if self.running:
+            self.backend.stop()
+            self.running = False
+
+    def _subscribe(self, subscription):
+        with self.lock:
+            if self.stream_ended:
+                subscription._put(None)
+            self.subscriptions.append(subscription)
+            self.changed.notify_all()
+
+    def _unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+                self.last_used = time.time()
+                self.changed.notify_all()
+        # the stream may be waiting for room in this subscription's queue
+        while True:
+            try:
+                subscription.queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def _wants_jpeg(self):
+        return any(s.keep_jpeg for s in self.subscriptions)
+
+    def _stream(self):
+        while True:
+            with self.lock:
+                # a burst has the camera's video port to itself while it lasts
+                while (not (self.subscriptions or self.closed.is_set()) or self.stream_ended
+                       or self.bursting):
+                    if self.closed.is_set():
+                        return
+                    self.changed.wait()
+                if self.closed.is_set():
+                    return
+                self._start()
+                size = self.subscriptions[0].size
+                keep_jpeg = self._wants_jpeg()
+                self.streaming = True
+            frames = self.backend.frames(size, keep_jpeg)
+            ended = True
+            try:
+                for luma, timestamp, data in frames:
+                    with self.lock:
+                        self.frame_counter += 1
+                        frame = Frame(self.frame_counter, timestamp, data, luma, size)
+                        subscriptions = list(self.subscriptions)
+                        self.last_used = time.time()
+                        # start again in the other mode, or stop, when the subscribers change
+                        restart = (not subscriptions or self.closed.is_set()
+                                   or keep_jpeg != self._wants_jpeg())
+                    for s in subscriptions:
+                        s._put(frame)
+                    if restart:
+                        ended = False
+                        # let go of the camera's port before opening it again
+                        frames.close()
+                        break
+            except Exception:
+                traceback.print_exc()
+            with self.lock:
+                self.streaming = False
+                if ended:
+                    # a recording or a dummy scene ran out of frames (or the
+                    # camera failed)
+                    self.stream_ended = True
+                subscriptions = list(self.subscriptions)
+                self.changed.notify_all()
+            if ended:
+                for s in subscriptions:
+                    s._put(None)
+
+    def subscribe(self, size=_detection_size, keep_jpeg=False, maxsize=2, policy=None, every=1):
+        "A Subscription to the frame stream, to be used with `with`."
+        return Subscription(self, size, keep_jpeg, maxsize, policy, every)
+
+    def annotate(self, text):
+        with self.lock:
+            self._start()
+            self.backend.annotate(text)
+
+    def take_picture(self, annotation=None):
+        """A full resolution (jpeg_bytes, timestamp) pair. The annotation is
+        drawn on this picture only, and only when it comes from the still
+        port rather than the shared stream."""
+        with self.lock:
+            from_stream = bool(self.subscriptions) and not self.stream_ended
+            if not from_stream:
+                self._start()
+                data, timestamp = self.backend.still(annotation)
+        if from_stream:
+            # The stream is shared, so the annotation isn't drawn: it would
+            # show up in every other subscriber's frames too.
+            with self.subscribe(keep_jpeg=True, maxsize=1, policy=writer.DROP_OLDEST) as s:
+                frame = s.next_frame()
+            if frame is None:
+                return self.take_picture(annotation)
+            data, timestamp = frame.data, frame.timestamp
+        with self.lock:
+            self.last_used = time.time()
+            self.image_counter += 1
+        return (data, timestamp)
+
+    def take_preview(self, size, quality=75):
+        """A (jpeg_bytes, timestamp) picture of size, resized by the camera on
+        a video port of its own, so it doesn't disturb a stream or recording."""
+        with self.lock:
+            self._start()
+            data, timestamp = self.backend.preview(size, quality)
+            self.last_used = time.time()
+        return (data, timestamp)
+
+    def burst(self, count):
+        """Generator of count full resolution (jpeg_bytes, timestamp) pairs,
+        taken as fast as the camera can. The frame rate achieved is kept in
+        burst_fps."""
+        start = time.time()
+        taken = 0
+        try:
+            with self.lock:
+                from_stream = bool(self.subscriptions) and not self.stream_ended
+            if from_stream:
+                with self.subscribe(keep_jpeg=True, maxsize=count, policy=writer.BLOCK) as s:
+                    while taken < count:
+                        frame = s.next_frame()
+                        if frame is None:
+                            break
+                        self.image_counter += 1
+                        taken += 1
+                        yield (frame.data, frame.timestamp)
+                return
+            # The lock is only held while each picture is taken, never while
+            # the caller has it, so a slow caller doesn't hold up everyone else.
+            with self.lock:
+                self._start()
+                self.bursting += 1
+            pictures = self.backend.burst(count)
+            try:
+                while True:
+                    with self.lock:
+                        try:
+                            data, timestamp = next(pictures)
+                        except StopIteration:
+                            break
+                        self.image_counter += 1
+                    taken += 1
+                    yield (data, timestamp)
+            finally:
+                pictures.close()
+                with self.lock:
+                    self.bursting -= 1
+                    self.changed.notify_all()
+        finally:
+            self.last_used = time.time()
+            elapsed = self.last_used - start
+            self.burst_fps = taken / elapsed if elapsed > 0 else 0.0
+
+    def start_recording(self, path):
+        with self.lock:
+            self._start()
+            self.backend.start_recording(path)
+            self.recording = path
+
+    def wait_recording(self, seconds):
+        "Sleep while recording, raising any error the recording ran into."
+        self.backend.wait_recording(seconds)
+
+    def stop_recording(self):
+        with self.lock:
+            if self.recording is not None:
+                self.backend.stop_recording()
+                self.recording = None
+                self.last_used = time.time()
+
+    def stop(self):
+        "Close the camera now rather than waiting for it to go idle."
+        with self.lock:
+            if not self.subscriptions and self.recording is None and not self.bursting:
+                self._stop()
+
+    def close(self):
+        with self.lock:
+            self.closed.set()
+            self.changed.notify_all()
+            subscriptions, self.subscriptions = self.subscriptions, []
+        for s in subscriptions:
+            self._unsubscribe(s)
+            s._put(None)
+        # let the stream finish with the camera before it is closed
+        self.threads[1].join(10)
+        self.stop_recording()
+        with self.lock:
+            self._stop()
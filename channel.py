@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Status messages from the camera process to the web server process, as
+# started by timelapse.py. The camera publishes its status and each new
+# capture; the server reads them from shared memory and pushes them to the
+# viewers as Server-Sent Events (/api/events), every viewer waking up when
+# a message arrives instead of polling.
+
+
+import json
+import multiprocessing
+import time
+
+
+STATUS = "status"
+CAPTURE = "capture"
+SLOTS = 32 # messages kept for readers that fall behind
+SLOT_BYTES = 1024 # longest message, as json
+KEEPALIVE = 15 # seconds between comments sent to idle viewers, to notice when they leave
+
+
+class StatusChannel:
+    """Versioned messages in shared memory, for processes forked after it
+    is made.
+
+    Every message is a dict with a kind (STATUS or CAPTURE), stored as json
+    in a ring of `slots` slots and numbered by version, the count of
+    messages published so far. Readers ask for everything after the last
+    version they saw; one that falls more than `slots` messages behind
+    misses the oldest. The latest status is also kept apart, so it is never
+    lost to a run of captures. Writes and reads hold the same lock, so a
+    reader never sees half a message.
+    """
+    def __init__(self, slots=SLOTS, slot_bytes=SLOT_BYTES):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.changed = multiprocessing.Condition()
+        self._version = multiprocessing.RawValue('l', 0)
+        self._lengths = multiprocessing.RawArray('i', slots + 1)
+        # the last slot holds the latest status
+        self._buffer = multiprocessing.RawArray('c', (slots + 1) * slot_bytes)
+
+    def _write(self, slot, message):
+        data = json.dumps(message).encode("utf-8")
+        if len(data) > self.slot_bytes:
+            raise ValueError("status message longer than {} bytes".format(self.slot_bytes))
+        start = slot * self.slot_bytes
+        self._buffer[start:start + len(data)] = data
+        self._lengths[slot] = len(data)
+
+    def _read(self, slot):
+        start = slot * self.slot_bytes
+        return json.loads(self._buffer[start:start + self._lengths[slot]].decode("utf-8"))
+
+    def publish(self, kind, **fields):
+        "Send a message to every reader; returns its version."
+        with self.changed:
+            version = self._version.value + 1
+            message = dict(fields, kind=kind, version=version, time=time.time())
+            self._write(version % self.slots, message)
+            if kind == STATUS:
+                self._write(self.slots, message)
+            self._version.value = version
+            self.changed.notify_all()
+        return version
+
+    @property
+    def version(self):
+        with self.changed:
+            return self._version.value
+
+    def status(self):
+        "The latest status message, or {} before the first."
+        with self.changed:
+            if self._lengths[self.slots] == 0:
+                return {}
+            return self._read(self.slots)
+
+    def read(self, since):
+        "(version, messages published after version since, oldest first)."
+        with self.changed:
+            version = self._version.value
+            first = max(since + 1, version - self.slots + 1, 1)
+            return (version, [self._read(v % self.slots) for v in range(first, version + 1)])
+
+    def wait(self, since, timeout=None):
+        """Like read(), but first waits up to timeout seconds for a message
+        after version since."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while self._version.value <= since:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+            return self.read(since)
+
+
+def server_sent_events(channel, last_event_id=None, keepalive=KEEPALIVE):
+    """A text/event-stream of the channel's messages, for as long as the
+    viewer stays. A new viewer starts with the latest status; one that
+    reconnects (sending Last-Event-ID) gets what it missed."""
+    yield "retry: 5000\n\n".encode("utf-8")
+    if last_event_id is None:
+        since = channel.version
+        status = channel.status()
+        if status:
+            yield _event(status)
+    else:
+        since = last_event_id
+    while True:
+        since, messages = channel.wait(since, keepalive)
+        if not messages:
+            yield ": keepalive\n\n".encode("utf-8")
+        for message in messages:
+            yield _event(message)
+
+
+def _event(message):
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(message["version"], message["kind"],
+                                                   json.dumps(message)).encode("utf-8")
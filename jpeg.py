@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Saving pictures as the jpeg bytes the camera made, shared by camera.py,
+# motion.py and timelapse_camera.py. Run it to compare with the old way of
+# decoding, re-encoding and resizing every picture:
+#
+#   python jpeg.py [picture.jpg]
+
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from PIL import Image
+
+
+def decode(data):
+    "The full resolution image."
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+def preview(data, size):
+    """A size preview of the picture. The jpeg decoder scales it down by 1/2,
+    1/4 or 1/8 as it decodes, so only about as many pixels as the preview
+    needs are ever decoded."""
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', size)
+    return image.resize(size)
+
+
+def save(data, path, preview_path=None, preview_size=None, preview_quality=75):
+    "Write the jpeg data unchanged, and a preview of it if asked for."
+    with open(path, "wb") as f:
+        f.write(data)
+    if preview_path is not None:
+        preview(data, preview_size).save(preview_path, quality=preview_quality)
+
+
+def _save_reencoded(data, path, preview_path, preview_size):
+    # how pictures used to be saved, for comparison
+    image = decode(data)
+    image.resize(preview_size).save(preview_path)
+    image.save(path, quality=90)
+
+
+def benchmark(data, repeat=5):
+    "Seconds per picture to save the old way and the new way."
+    size = Image.open(io.BytesIO(data)).size
+    preview_size = (size[0] // 3, size[1] // 3)
+    directory = tempfile.mkdtemp()
+    path, preview_path = os.path.join(directory, "a.jpg"), os.path.join(directory, "p.jpg")
+    try:
+        before = min(timeit.repeat(lambda: _save_reencoded(data, path, preview_path, preview_size),
+                                   number=1, repeat=repeat))
+        after = min(timeit.repeat(lambda: save(data, path, preview_path, preview_size),
+                                  number=1, repeat=repeat))
+    finally:
+        shutil.rmtree(directory)
+    return (before, after)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            data = f.read()
+    else:
+        stream = io.BytesIO()
+        Image.effect_noise((2592, 1944), 40).convert('RGB').save(stream, format='JPEG', quality=85)
+        data = stream.getvalue()
+    before, after = benchmark(data)
+    print("decode + re-encode: {:.1f} ms".format(before * 1000))
+    print("original bytes + reduced scale preview: {:.1f} ms".format(after * 1000))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Light metering shared by camera.py, motion.py and timelapse_camera.py.
+# Light levels are the mean brightness of the picture, from 0 (black) to
+# 255 (white), whatever the picture size.
+
+
+import io
+
+import numpy as np
+from PIL import Image
+
+
+DARK_LEVEL = 3.0 # too dark to take pictures below this
+LIGHT_LEVEL = 5.0 # once too dark, light enough again above this
+
+
+def level(data):
+    "Light level of a jpeg, decoded at 1/8 scale."
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (image.size[0] // 8, image.size[1] // 8))
+    return level_of(image.convert('L'))
+
+
+def level_of(image):
+    "Light level of an image or a (luma) array."
+    return float(np.mean(np.asarray(image)))
+
+
+class DarknessMonitor:
+    """Decides when it is too dark to take pictures, and how long to sleep
+    before looking again.
+
+    It becomes too dark below `dark` and only stops being too dark above
+    `light`, so a light level hovering around one cutoff doesn't flip back
+    and forth. While it stays dark, the sleeps double from min_sleep up to
+    max_sleep seconds.
+    """
+    def __init__(self, min_sleep, max_sleep, dark=DARK_LEVEL, light=LIGHT_LEVEL):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.dark = dark
+        self.light = light
+        self.too_dark = False
+        self.sleep_time = 0
+
+    def check(self, light_level):
+        "Seconds to sleep before the next picture; 0 when it is light enough."
+        if self.too_dark:
+            self.too_dark = light_level < self.light
+        else:
+            self.too_dark = light_level < self.dark
+        if not self.too_dark:
+            self.sleep_time = 0
+        elif self.sleep_time == 0:
+            self.sleep_time = self.min_sleep
+        else:
+            self.sleep_time = min(self.sleep_time * 2, self.max_sleep)
+        return self.sleep_time
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Where the time goes in the capture loops. camera.py, motion.py,
+# timelapse_camera.py and video.py each keep counters and a latency
+# histogram per stage in a small memory mapped file on the ramdisk, and the
+# web servers read every such file to serve /api/metrics as JSON or, with
+# ?format=prometheus, as Prometheus text.
+
+
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import threading
+import time
+import timeit
+
+import numpy as np
+
+
+METRICS_DIRECTORY = "/mnt/ramdisk/metrics"
+# upper bounds of the latency histogram buckets, in seconds; anything slower
+# goes in a last, unbounded bucket
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+_HEADER_BYTES = 4096
+# each row is: count, sum of seconds, one count per bucket
+_COLUMNS = 2 + len(BUCKETS) + 1
+
+
+class Metrics:
+    """Counters and per stage latency histograms for one program.
+
+    Everything lives in one preallocated float64 array, mapped from
+    directory/<program>.metrics, so recording a time is a few additions and
+    the server reads it without talking to the program at all. If the file
+    can't be made the array is kept in memory only.
+    """
+    def __init__(self, program, stages, counters=(), directory=None):
+        self.program = program
+        self.stages = list(stages)
+        self.counters = list(counters)
+        self.index = dict((name, i) for i, name in enumerate(self.stages + self.counters))
+        self.lock = threading.Lock()
+        shape = (len(self.index), _COLUMNS)
+        if directory is None:
+            directory = METRICS_DIRECTORY
+        try:
+            self.path = self._create(directory, shape)
+            with open(self.path, "r+b") as f:
+                self._map = mmap.mmap(f.fileno(), 0)
+            self.data = np.ndarray(shape, np.float64, buffer=self._map, offset=_HEADER_BYTES)
+        except (OSError, IOError) as e:
+            print("metrics: not shared ({})".format(e))
+            self.path = None
+            self.data = np.zeros(shape)
+
+    def _create(self, directory, shape):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        header = json.dumps({"program": self.program,
+                             "pid": os.getpid(),
+                             "started": time.time(),
+                             "stages": self.stages,
+                             "counters": self.counters,
+                             "buckets": BUCKETS}).encode("ascii")
+        if len(header) >= _HEADER_BYTES:
+            raise ValueError("too many metrics for the header")
+        path = os.path.join(directory, self.program + ".metrics")
+        # written whole and then renamed, so the server never sees half a file
+        with open(path + ".new", "wb") as f:
+            f.write(header.ljust(_HEADER_BYTES))
+            f.write(np.zeros(shape).tobytes())
+        os.rename(path + ".new", path)
+        return path
+
+    def observe(self, stage, seconds):
+        i = self.index[stage]
+        with self.lock:
+            self.data[i, 0] += 1
+            self.data[i, 1] += seconds
+            self.data[i, 2 + bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def increment(self, counter, n=1):
+        i = self.index[counter]
+        with self.lock:
+            self.data[i, 0] += n
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe(stage, timeit.default_timer() - start)
+
+    def summary(self):
+        return _summary(self.program, self.stages, self.counters, self.data)
+
+
+def _summary(program, stages, counters, data):
+    result = {"program": program, "stages": {}, "counters": {}}
+    for i, stage in enumerate(stages):
+        count, total = int(data[i, 0]), float(data[i, 1])
+        cumulative = np.cumsum(data[i, 2:]).astype(int).tolist()
+        buckets = [[le, n] for le, n in zip(BUCKETS, cumulative)] + [["+Inf", cumulative[-1]]]
+        result["stages"][stage] = {"count": count,
+                                   "sum_seconds": total,
+                                   "mean_ms": total / count * 1000 if count else 0.0,
+                                   "buckets": buckets}
+    for i, counter in enumerate(counters, len(stages)):
+        result["counters"][counter] = int(data[i, 0])
+    return result
+
+
+def read(path):
+    "Summary of a metrics file written by another process."
+    with open(path, "rb") as f:
+        raw = f.read()
+    header = json.loads(raw[:_HEADER_BYTES].decode("ascii"))
+    rows = len(header["stages"]) + len(header["counters"])
+    data = np.frombuffer(raw, np.float64, rows * _COLUMNS, _HEADER_BYTES).reshape((rows, _COLUMNS))
+    result = _summary(header["program"], header["stages"], header["counters"], data)
+    result["pid"] = header["pid"]
+    result["started"] = header["started"]
+    return result
+
+
+def read_all(directory=None):
+    "Summaries of every program's metrics, by program name."
+    if directory is None:
+        directory = METRICS_DIRECTORY
+    programs = {}
+    if os.path.isdir(directory):
+        for f in sorted(os.listdir(directory)):
+            if f.endswith(".metrics"):
+                try:
+                    summary = read(os.path.join(directory, f))
+                except (IOError, OSError, ValueError):
+                    continue
+                programs[summary["program"]] = summary
+    return programs
+
+
+def prometheus(programs):
+    "Prometheus text exposition of read_all()'s summaries."
+    lines = ["# HELP cloudberry_stage_seconds Time taken by each stage of the capture loops.",
+             "# TYPE cloudberry_stage_seconds histogram"]
+    for program, summary in sorted(programs.items()):
+        for stage, s in sorted(summary["stages"].items()):
+            labels = 'program="{}",stage="{}"'.format(program, stage)
+            for le, n in s["buckets"]:
+                lines.append('cloudberry_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, n))
+            lines.append("cloudberry_stage_seconds_sum{{{}}} {!r}".format(labels, s["sum_seconds"]))
+            lines.append("cloudberry_stage_seconds_count{{{}}} {}".format(labels, s["count"]))
+    lines += ["# HELP cloudberry_total Things counted by the capture loops.",
+              "# TYPE cloudberry_total counter"]
+    for program, summary in sorted(programs.items()):
+        for counter, n in sorted(summary["counters"].items()):
+            lines.append('cloudberry_total{{program="{}",counter="{}"}} {}'.format(program, counter, n))
+    return "\n".join(lines) + "\n"
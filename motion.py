@@ -17,64 +17,98 @@ from __future__ import division, print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import argparse
 import collections
-import datetime
 import os
 import shutil
-import StringIO
-import subprocess
 import sys
 import time
+import timeit
 
 from PIL import Image
 import numpy as np
 
+import capture
+import jpeg
+import light
+import metrics
+import storage
+import writer
 
-_preview_directory = "previews"
-_event_directory = "events"
+# CPU time used by the calling thread (or, where that isn't available, the
+# whole process), for timing the detector
+_cpu_time = getattr(time, "thread_time", None) or getattr(time, "process_time", None) or time.clock
+
+
+_current_directory = os.path.dirname(os.path.abspath(__file__))
+_preview_directory = _current_directory + "/previews"
+_event_directory = _current_directory + "/events"
+_index_path = _current_directory + "/captures.db"
 BACKGROUND_QUEUE_SIZE = 60
 _image_width = 2592
 _image_height = 1944
 _preview_width = _image_width // 3
 _preview_heigh = _image_height // 3
-IMAGE_QUEUE_SIZE = 3
+IMAGE_QUEUE_SIZE = 15 # pictures kept around an event, as jpeg bytes
 SIGMA = 4
-EVENT_THRESHOLD = 0.0025
-SNAPSHOT_PIXELS = 160*120*3
-DARKNESS_CUTOFF = 100
-DARKNESS_SLEEPTIME = 600
+TILE_SIZE = 8 # detection frames are scored in 8x8 pixel tiles
+TILE_THRESHOLD = 0.1 # fraction of a tile in the foreground to count as changed
+BLOB_MIN_PIXELS = 12
+BLOB_MAX_PIXELS = 160*120 // 8
+BLOB_MIN_FILL = 0.25 # fraction of a blob's bounding box in the foreground
+BACKGROUND_MODEL = "window" # or "mixture", see BACKGROUND_MODELS
+MIXTURE_COMPONENTS = 3
+MIXTURE_ALPHA = 0.01 # learning rate of the mixture model
+MIXTURE_BACKGROUND_WEIGHT = 0.9 # share of the mixture that is background
+MIXTURE_MATCH_SIGMA = 2.5
+MIXTURE_INITIAL_VARIANCE = 15.0 ** 2
+MIXTURE_MINIMUM_VARIANCE = 2.0 ** 2
+PYRAMID = False # detect coarse to fine, see PyramidDetector
+PYRAMID_SCALE = 4 # the coarse level is 40x30
+INCLUDE_MASK = None # optional black and white images, white marks the area to
+EXCLUDE_MASK = None # watch (include) or to ignore (exclude)
+SNAPSHOT_SHAPE = (120, 160)
+SNAPSHOT_PIXELS = 160*120
+DARKNESS_MIN_SLEEPTIME = 60 # seconds; doubles each time it is still too dark
+DARKNESS_MAX_SLEEPTIME = 600
 HEARTBEAT = 2
+DRAFT_DECODE = True # decode jpegs at reduced scale for detection
+WRITER_QUEUE_SIZE = 2 * IMAGE_QUEUE_SIZE
+WRITER_POLICY = writer.DROP_OLDEST
 
 
 class Picture:
-    def __init__(self, image, timestamp):
+    def __init__(self, image, timestamp, thumbnail=None, data=None):
         self.image = image
         self.timestamp = timestamp
+        # low resolution luma frame used for detection, if the camera
+        # provided one
+        self.thumbnail = thumbnail
+        # the picture as jpeg data, if it came from the camera that way
+        self.data = data
+        # for the capture index, once they are known
+        self.brightness = None
+        self.motion_score = None
+        self.event_id = None
 
-
-class RPiCamera:
-    def __init__(self, image_size=(_image_width, _image_height)):
-        self.image_size = image_size
-        self.image_counter = 0
-        self.start_time = datetime.datetime.now()
-
-    def take_picture(self):
-        command = "raspistill -n -mm average -w {} -h {} -ISO 200 -q 100 -t 1000 -e bmp -o -".format(self.image_size[0], self.image_size[1])
-        image_data = StringIO.StringIO()
-        image_data.write(subprocess.check_output(command, shell=True))
-        image_data.seek(0)
-        image = Image.open(image_data)
-        image.load()
-        image_data.close()
-        timestamp = datetime.datetime.now()
-        self.image_counter += 1
-        return Picture(image, timestamp)
+    def load(self):
+        "The full resolution image, decoded from data the first time it is needed."
+        if self.image is None:
+            self.image = jpeg.decode(self.data)
+        return self.image
 
 
 
 def preprocess_image(i):
-    im = i.image
-    im = im.resize((160,120))
+    if i.thumbnail is not None:
+        return i.thumbnail
+    if i.data is not None and DRAFT_DECODE:
+        # Have the jpeg decoder scale the picture down by 1/2, 1/4 or 1/8 as
+        # it decodes (the smallest that is still at least 160x120), rather
+        # than decoding every pixel only to throw nearly all of them away.
+        return capture.luma_from_jpeg(i.data, (160,120))
+    im = i.load()
+    im = im.convert('L').resize((160,120))
     # convert color RGB image to grayscale. This gives a greater range
     # of values than Image.convert('L')
     #r, g, b = (np.asarray(band, dtype="u4") for band in im.split())
@@ -84,48 +118,393 @@ def preprocess_image(i):
 
 
 def calc_stats(xs):
-    n = len(xs)
-    mean = sum(xs) / n
-    stdev = np.sqrt(sum(np.square(x - mean) for x in xs) / n)
+    # sum in floating point; adding up uint8 frames directly wraps around
+    xs = np.asarray(xs, dtype=np.float64)
+    mean = xs.mean(axis=0)
+    stdev = xs.std(axis=0)
     return (mean, stdev)
 
 
-def find_foreground(b, x, factor):
-    m, s = calc_stats(b)
-    diff = np.abs(x - m)
-    foreground_pixels = (diff > (s * factor)).sum()
-    return foreground_pixels
+class RingBuffer:
+    """A fixed number of equally shaped arrays kept in one preallocated block.
+
+    Appending copies into the slot of the oldest item, so once the buffer
+    is allocated no more memory is needed however many frames go through it.
+    """
+    def __init__(self, size, shape, dtype=np.uint8):
+        self.size = size
+        self.data = np.zeros((size,) + tuple(shape), dtype=dtype)
+        self.start = 0 # slot holding the oldest item
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("ring buffer index out of range")
+        return self.data[(self.start + i) % self.size]
+
+    def full(self):
+        return self.count == self.size
+
+    def append(self, x):
+        if self.full():
+            slot = self.start
+            self.start = (self.start + 1) % self.size
+        else:
+            slot = self.count
+            self.count += 1
+        np.copyto(self.data[slot], x)
+        return self.data[slot]
+
+
+class BackgroundModel:
+    """Running mean and standard deviation over the last `size` frames.
+
+    Keeps a sum and a sum of squares for every pixel so that adding a frame
+    (and dropping the oldest one) is O(pixels), rather than recomputing the
+    statistics over the whole window like calc_stats does. Frames, sums and
+    scratch space are all allocated up front.
+    """
+    def __init__(self, size, shape=SNAPSHOT_SHAPE):
+        self.size = size
+        self.frames = RingBuffer(size, shape, np.uint8)
+        # Sums are kept as float64 rather than uint8 so they can't wrap around.
+        # Every value computed from them below is an integer well under
+        # 2**53, so float64 holds it exactly.
+        self.total = np.zeros(shape, dtype=np.float64)
+        self.total_sq = np.zeros(shape, dtype=np.float64)
+        self._a = np.zeros(shape, dtype=np.float64)
+        self._b = np.zeros(shape, dtype=np.float64)
+        self._c = np.zeros(shape, dtype=np.float64)
+        self._mask = np.zeros(shape, dtype=bool)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _add(self, x, sign):
+        update = np.add if sign > 0 else np.subtract
+        a = self._a
+        np.copyto(a, x)
+        update(self.total, a, out=self.total)
+        np.multiply(a, a, out=a)
+        update(self.total_sq, a, out=self.total_sq)
+
+    def append(self, x):
+        if self.frames.full():
+            self._add(self.frames[0], -1)
+        self._add(self.frames.append(x), 1)
+
+    def stats(self):
+        n = len(self.frames)
+        mean = self.total / n
+        variance = (n * self.total_sq - self.total * self.total) / (n * n)
+        stdev = np.sqrt(variance)
+        return (mean, stdev)
+
+    def foreground_mask(self, x, factor, where=True):
+        """Mark the pixels in x more than factor standard deviations from
+        the mean. Works on n times the deviations, squared, so that for an
+        integer factor the test is exact and pixels sitting right on the
+        threshold are not decided by floating point rounding. Only pixels
+        where `where` is True are looked at; the rest are left unmarked.
+
+        The mask returned is reused by the next call."""
+        n = len(self.frames)
+        deviation, spread = self._a, self._b
+        np.copyto(deviation, x, where=where)
+        np.multiply(deviation, n, out=deviation, where=where)
+        np.subtract(deviation, self.total, out=deviation, where=where)
+        np.multiply(deviation, deviation, out=deviation, where=where)
+        np.multiply(self.total_sq, n, out=spread, where=where)
+        np.multiply(self.total, self.total, out=self._c, where=where)
+        np.subtract(spread, self._c, out=spread, where=where)
+        np.multiply(spread, factor * factor, out=spread, where=where)
+        self._mask[...] = False
+        return np.greater(deviation, spread, out=self._mask, where=where)
+
+    def foreground(self, x, factor):
+        "Count the pixels in x more than factor standard deviations from the mean."
+        return np.count_nonzero(self.foreground_mask(x, factor))
+
+
+class MixtureModel:
+    """Per-pixel mixture of gaussians background model (Stauffer & Grimson).
+
+    Each pixel keeps `components` gaussians with a weight, mean and
+    variance. A pixel is background when it is within factor standard
+    deviations of one of the heaviest, tightest gaussians, so a background
+    that flickers between a few values (leaves moving in and out of the
+    shade) is learned as background too, and gradual light changes are
+    followed at the learning rate. Everything is done on whole arrays.
+
+    alpha is the learning rate, either one number or an array with a rate
+    for every pixel. For the first `size` frames each pixel learns at least
+    as fast as a running average would, so the model settles quickly.
+    """
+    def __init__(self, size, shape=SNAPSHOT_SHAPE, components=MIXTURE_COMPONENTS,
+                 alpha=MIXTURE_ALPHA, background_weight=MIXTURE_BACKGROUND_WEIGHT):
+        self.size = size
+        self.count = 0
+        self.alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float32), shape)
+        self.background_weight = background_weight
+        self.weight = np.zeros((components,) + tuple(shape), dtype=np.float32)
+        self.mean = np.zeros((components,) + tuple(shape), dtype=np.float32)
+        self.variance = np.full((components,) + tuple(shape), MIXTURE_INITIAL_VARIANCE,
+                                dtype=np.float32)
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def _distance(self, x):
+        "Squared distance of x from each gaussian, in variances."
+        return np.square(x.astype(np.float32) - self.mean) / self.variance
+
+    def _background(self):
+        "Which gaussians are part of the background model."
+        fitness = self.weight / np.sqrt(self.variance)
+        # weight of the gaussians that fit better than each one; a gaussian is
+        # background until the ones ahead of it add up to background_weight
+        ahead = (fitness[np.newaxis] > fitness[:, np.newaxis]) * self.weight[np.newaxis]
+        return (ahead.sum(axis=1) < self.background_weight) & (self.weight > 0)
+
+    def foreground_mask(self, x, factor, where=True):
+        match = self._distance(x) < factor * factor
+        return ~(match & self._background()).any(axis=0) & where
+
+    def foreground(self, x, factor):
+        return np.count_nonzero(self.foreground_mask(x, factor))
+
+    def append(self, x, factor=MIXTURE_MATCH_SIGMA):
+        self.count += 1
+        alpha = np.maximum(self.alpha, 1 / self.count) if self.count <= self.size else self.alpha
+        x = x.astype(np.float32)
+        distance = self._distance(x)
+        distance[(distance >= factor * factor) | (self.weight == 0)] = np.inf
+        best = distance.argmin(axis=0)
+        matched = np.isfinite(distance.min(axis=0))
+        components = np.arange(self.weight.shape[0]).reshape((-1,) + (1,) * x.ndim)
+        owner = (components == best) & matched
+
+        # pull the matched gaussian towards x
+        self.weight *= 1 - alpha
+        self.weight += alpha * owner
+        rho = np.minimum(alpha / np.maximum(self.weight, 1e-6), 1) * owner
+        difference = x - self.mean
+        self.mean += rho * difference
+        self.variance += rho * (np.square(difference) - self.variance)
+        np.maximum(self.variance, MIXTURE_MINIMUM_VARIANCE, out=self.variance)
+
+        # pixels that matched nothing replace their weakest gaussian with a
+        # new, wide one centred on x
+        weakest = (components == self.weight.argmin(axis=0)) & ~matched
+        self.weight = np.where(weakest, alpha, self.weight).astype(np.float32)
+        self.mean = np.where(weakest, x, self.mean).astype(np.float32)
+        self.variance[weakest] = MIXTURE_INITIAL_VARIANCE
+        self.weight /= self.weight.sum(axis=0)
+
+
+BACKGROUND_MODELS = {"window": BackgroundModel, "mixture": MixtureModel}
+
+
+def shrink(x, scale):
+    "Average scale x scale blocks of pixels; the dimensions of x must divide by scale."
+    rows, columns = x.shape[0] // scale, x.shape[1] // scale
+    blocks = x.reshape(rows, scale, columns, scale)
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32) // (scale * scale)).astype(np.uint8)
+
+
+def _neighbours(mask):
+    "Where any of a pixel's eight neighbours is set in mask."
+    n = np.zeros_like(mask)
+    n[1:] |= mask[:-1]
+    n[:-1] |= mask[1:]
+    n[:, 1:] |= mask[:, :-1]
+    n[:, :-1] |= mask[:, 1:]
+    n[1:, 1:] |= mask[:-1, :-1]
+    n[1:, :-1] |= mask[:-1, 1:]
+    n[:-1, 1:] |= mask[1:, :-1]
+    n[:-1, :-1] |= mask[1:, 1:]
+    return n
+
+
+class PyramidDetector:
+    """Coarse to fine detection over two background models.
+
+    Each frame is first compared against a background model of a thumbnail
+    `scale` times smaller. If nothing changed there (as in most frames), or
+    only single pixels with no changed neighbours (sensor noise), the frame
+    is done. Otherwise only the blocks around what changed are looked at in
+    the full detection frame. Looks like a background model, so it can
+    be used wherever one is.
+    """
+    def __init__(self, size, model=BACKGROUND_MODEL, shape=SNAPSHOT_SHAPE, scale=PYRAMID_SCALE):
+        self.size = size
+        self.scale = scale
+        self.coarse = BACKGROUND_MODELS[model](size, (shape[0] // scale, shape[1] // scale))
+        self.fine = BACKGROUND_MODELS[model](size, shape)
+        self.empty = np.zeros(shape, dtype=bool)
+        self._last = (None, None)
+        self.frames = {"coarse": 0, "fine": 0}
+        self.cpu_time = {"coarse": 0.0, "fine": 0.0}
+
+    def __len__(self):
+        return len(self.fine)
+
+    def _shrink(self, x):
+        # the frame just looked at is usually appended next, so keep its thumbnail
+        if self._last[0] is not x:
+            self._last = (x, shrink(x, self.scale))
+        return self._last[1]
+
+    def append(self, x):
+        self.coarse.append(self._shrink(x))
+        self.fine.append(x)
+
+    def foreground_mask(self, x, factor, where=True):
+        start = _cpu_time()
+        changed = self.coarse.foreground_mask(self._shrink(x), factor)
+        if where is not True:
+            rows, columns = changed.shape
+            changed &= where.reshape(rows, self.scale, columns, self.scale).any(axis=(1, 3))
+        # anything moving changes a few neighbouring blocks; noise changes
+        # them one at a time
+        changed &= _neighbours(changed)
+        self.frames["coarse"] += 1
+        self.cpu_time["coarse"] += _cpu_time() - start
+        if not changed.any():
+            return self.empty
+        start = _cpu_time()
+        # grow the changed blocks by one in every direction so something only
+        # partly inside a block is looked at in full
+        grown = changed | _neighbours(changed)
+        grown = np.repeat(np.repeat(grown, self.scale, axis=0), self.scale, axis=1)
+        mask = self.fine.foreground_mask(x, factor, grown & where)
+        self.frames["fine"] += 1
+        self.cpu_time["fine"] += _cpu_time() - start
+        return mask
+
+    def foreground(self, x, factor):
+        return np.count_nonzero(self.foreground_mask(x, factor))
+
+    def level_times(self):
+        "Average CPU milliseconds per frame spent at each level."
+        frames = max(self.frames["coarse"], 1)
+        return dict((level, 1000 * t / frames) for level, t in self.cpu_time.items())
 
 
-def warm_up(background_queue_size, image_queue_size):
-    background_queue = collections.deque(maxlen=background_queue_size)
-    image_queue = collections.deque(maxlen=image_queue_size)
+def find_foreground(b, x, factor):
+    return b.foreground(x, factor)
+
+
+# A blob is a group of neighbouring tiles with enough foreground pixels in
+# them. pixels is the number of foreground pixels in the blob, box is
+# (left, top, right, bottom) around them, in detection frame coordinates.
+Blob = collections.namedtuple("Blob", "pixels box tiles")
+
+
+def load_mask(path, shape=SNAPSHOT_SHAPE):
+    "Read a black and white mask image; white areas are True."
+    im = Image.open(path).convert('L').resize((shape[1], shape[0]))
+    return np.asarray(im) > 127
+
+
+def region_of_interest(include=None, exclude=None, shape=SNAPSHOT_SHAPE):
+    "Combine include and exclude masks into one; None means no restriction."
+    roi = np.ones(shape, dtype=bool)
+    if include is not None:
+        roi &= include
+    if exclude is not None:
+        roi &= ~exclude
+    return roi
+
+
+def score_tiles(mask, tile_size=TILE_SIZE):
+    "Fraction of foreground pixels in each tile_size x tile_size tile."
+    rows, columns = mask.shape[0] // tile_size, mask.shape[1] // tile_size
+    tiles = mask[:rows * tile_size, :columns * tile_size]
+    tiles = tiles.reshape(rows, tile_size, columns, tile_size)
+    return tiles.sum(axis=(1, 3)) / (tile_size * tile_size)
+
+
+def find_blobs(mask, tile_size=TILE_SIZE, threshold=TILE_THRESHOLD):
+    """Group the tiles of a foreground mask that score above threshold into
+    connected blobs (neighbouring horizontally or vertically). The tile grid
+    is small (20x15 by default) so walking it in Python is cheap."""
+    scores = score_tiles(mask, tile_size)
+    active = scores > threshold
+    seen = np.zeros(active.shape, dtype=bool)
+    blobs = []
+    for start in zip(*np.nonzero(active)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        tiles = []
+        todo = [start]
+        while todo:
+            r, c = todo.pop()
+            tiles.append((r, c))
+            for n in ((r-1, c), (r+1, c), (r, c-1), (r, c+1)):
+                if (0 <= n[0] < active.shape[0] and 0 <= n[1] < active.shape[1]
+                        and active[n] and not seen[n]):
+                    seen[n] = True
+                    todo.append(n)
+        rows, columns = zip(*tiles)
+        # pixels outside the blob's own tiles but inside its box belong to
+        # other blobs (or to nothing), so only count the blob's tiles
+        blob_mask = np.zeros(active.shape, dtype=bool)
+        blob_mask[rows, columns] = True
+        blob_mask = np.repeat(np.repeat(blob_mask, tile_size, axis=0), tile_size, axis=1)
+        ys, xs = np.nonzero(mask[:blob_mask.shape[0], :blob_mask.shape[1]] & blob_mask)
+        box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        blobs.append(Blob(len(xs), box, [(int(r), int(c)) for r, c in tiles]))
+    return blobs
+
+
+def is_visitor(blob):
+    "Is the blob about the size and shape of something visiting a flower?"
+    left, top, right, bottom = blob.box
+    fill = blob.pixels / ((right - left) * (bottom - top))
+    return (BLOB_MIN_PIXELS <= blob.pixels <= BLOB_MAX_PIXELS) and fill >= BLOB_MIN_FILL
+
+
+def find_visitors(b, x, factor, roi=None):
+    "Blobs in x that look like visitors, along with all blobs found."
+    mask = b.foreground_mask(x, factor)
+    if roi is not None:
+        mask &= roi
+    blobs = find_blobs(mask)
+    return ([blob for blob in blobs if is_visitor(blob)], blobs)
+
+
+def warm_up(frames, background_queue_size, model=BACKGROUND_MODEL, pyramid=PYRAMID):
+    if pyramid:
+        background_queue = PyramidDetector(background_queue_size, model)
+    else:
+        background_queue = BACKGROUND_MODELS[model](background_queue_size)
     for x in range(background_queue_size, 0, -1):
-        im = RPiCameraImage()
-        m = preprocess_image(im)
+        m, timestamp, data = next(frames)
         background_queue.append(m)
-        if x <= image_queue_size:
-            image_queue.append(im)
         print("\rwarming up... {:>3}".format(x), end="")
         sys.stdout.flush()
     print("\r{:60}".format(""), end="\r")
-    return (background_queue, image_queue)
+    return background_queue
 
 
-def do_event(background_queue, image_queue, event_counter):
+def do_event(background_queue, image_queue, event_counter, event_writer):
+    "Hand the event images to the writer; they are saved in the background."
     print("\r{:60}".format(""), end="\r")
     n = len(image_queue)
     midpoint = n // 2
     for x in range(0,n):
         im = image_queue.popleft()
-        image = im.image
         ts = im.timestamp
         print("===> event: {} time: {}".format(event_counter,
                                                 ts.strftime("%x %X")))
-        outfile = "{:05d}_{}.jpg".format(event_counter, ts.strftime("%Y%b%d_%H%M%S"))
-        preview = image.resize((_preview_width,_preview_heigh))
-        preview.save(os.path.join(_preview_directory, outfile))
-        image.save(os.path.join(_event_directory, outfile), quality=90)
+        event_writer.put(im, event_counter)
         event_counter += 1
         # Images after the midpoint in the image queue have not been added yet to the back-
         # ground queue, so add them now.
@@ -135,21 +514,33 @@ def do_event(background_queue, image_queue, event_counter):
     return (background_queue, image_queue, event_counter)
 
 
+def picture_paths(image_counter, timestamp):
+    "Where a picture and its preview go, in a directory for each hour."
+    outfile = "{:05d}_{}.jpg".format(image_counter,
+                timestamp.strftime("%Y%b%d_%H%M%S"))
+    return (os.path.join(storage.shard_directory(_event_directory, timestamp), outfile),
+            os.path.join(storage.shard_directory(_preview_directory, timestamp), outfile))
 
 
-
-
-def brightness(image):
-    m = numpy.asarray(image)
-    return numpy.sum(m)
+def save_picture(picture, image_counter, index=None):
+    if picture.data is None:
+        path, preview_path = save_image(picture.load(), image_counter, picture.timestamp)
+    else:
+        # Write the jpeg exactly as the camera made it; only the (much smaller)
+        # preview needs decoding, and only at reduced scale.
+        path, preview_path = picture_paths(image_counter, picture.timestamp)
+        jpeg.save(picture.data, path, preview_path, (_preview_width,_preview_heigh))
+    if index is not None:
+        index.add(path, picture.timestamp, os.path.getsize(path), brightness=picture.brightness,
+                  motion_score=picture.motion_score, event_id=picture.event_id, preview=preview_path)
 
 
 def save_image(image, image_counter, timestamp):
-    outfile = "{:05d}_{}.jpg".format(image_counter,
-                timestamp.strftime("%Y%b%d_%H%M%S"))
+    path, preview_path = picture_paths(image_counter, timestamp)
     preview = image.resize((_preview_width,_preview_heigh))
-    preview.save(os.path.join(_preview_directory, outfile))
-    image.save(os.path.join(_event_directory, outfile), quality=90)
+    preview.save(preview_path)
+    image.save(path, quality=90)
+    return (path, preview_path)
 
 
 def free_space():
@@ -159,47 +550,108 @@ def free_space():
 
 
 
-def run():
-    camera = RPiCamera((_image_width, _image_height))
+def run(backend=None, model=BACKGROUND_MODEL, pyramid=PYRAMID, engine=None):
+    "Watch for visitors, with a camera of its own or a share of engine's."
+    if engine is None:
+        if backend is None:
+            backend = capture.PiCameraBackend((_image_width, _image_height))
+        engine = capture.CaptureEngine(backend)
 
     event_counter = 0
-    too_dark = False
-
-    background_queue, image_queue = warm_up(BACKGROUND_QUEUE_SIZE, IMAGE_QUEUE_SIZE)
-
-    # main run loop
-    while True:
-        im = camera.take_picture()
-        image_queue.append(im)
-        # sample from the mid point of the image queue. By doing this, we can save
-        # to disk a few images before and after an event happens.
-        i = image_queue[len(image_queue) // 2]
-        m = preprocess_image(i)
-        # estimate how many pixels are in the foreground
-        fg = find_foreground(background_queue, m, SIGMA) / SNAPSHOT_PIXELS
-        print("\r{:6} {:5.2f}%".format(camera.image_counter, fg * 100), end="")
-        sys.stdout.flush()
-        if fg > EVENT_THRESHOLD:
-            # get a full-sized image and save it to a file
-            background_queue, image_queue, event_counter = do_event(background_queue,
-                                                                    image_queue,
-                                                                    event_counter)
-        # If the image is very dark, then switch to darkness mode, pause for a few
-        # minutes between taking thumbnails to save power
-        if (image_counter % HEARTBEAT == 0) or too_dark:
-            light_level = brightness(m)
-            if light_level < DARKNESS_CUTOFF:
-                too_dark = True
-                print("\r{:6} sleeping (too dark, light level {})".format(image_counter,
-                        light_level), end="")
-                sys.stdout.flush()
-                time.sleep(DARKNESS_SLEEPTIME)
-                print("\r{:70}".format(""), end="\r")
-            else:
-                too_dark = False
-        background_queue.append(m)
-
+    darkness = light.DarknessMonitor(DARKNESS_MIN_SLEEPTIME, DARKNESS_MAX_SLEEPTIME)
+    timings = metrics.Metrics("motion", ("frame", "preprocess", "detect", "event", "save",
+                                         "brightness", "sleep", "update"), ("frames", "events"))
+
+    def save(picture, image_counter):
+        with timings.timed("save"):
+            save_picture(picture, image_counter, index)
+
+    with storage.CaptureIndex(_index_path) as index, engine, \
+         writer.BackgroundWriter(save, WRITER_QUEUE_SIZE, WRITER_POLICY) as event_writer:
+        # event ids carry on from the last run
+        event_id = index.last_event_id()
+        background_queue = None
+        image_queue = collections.deque(maxlen=IMAGE_QUEUE_SIZE)
+        roi = region_of_interest(INCLUDE_MASK and load_mask(INCLUDE_MASK),
+                                 EXCLUDE_MASK and load_mask(EXCLUDE_MASK))
+
+        while True:
+            with engine.subscribe(keep_jpeg=True) as session:
+                frames = session.frames()
+                if background_queue is None:
+                    background_queue = warm_up(frames, BACKGROUND_QUEUE_SIZE, model, pyramid)
+                # main run loop
+                # "frame" is the wait for the next frame from the camera, including
+                # decoding its detection thumbnail
+                frame_start = timeit.default_timer()
+                for luma, timestamp, data in frames:
+                    timings.observe("frame", timeit.default_timer() - frame_start)
+                    timings.increment("frames")
+                    # The queue holds the pictures as jpeg bytes straight from the
+                    # camera, a small fraction of the memory decoded images would need.
+                    image_queue.append(Picture(None, timestamp, thumbnail=luma, data=data))
+                    # sample from the mid point of the image queue. By doing this, we can save
+                    # to disk a few images before and after an event happens.
+                    i = image_queue[len(image_queue) // 2]
+                    with timings.timed("preprocess"):
+                        m = preprocess_image(i)
+                    # look for compact groups of changed pixels; changes scattered all
+                    # over the picture (wind in the leaves) don't count
+                    with timings.timed("detect"):
+                        visitors, blobs = find_visitors(background_queue, m, SIGMA, roi)
+                    # the fraction of the picture taken up by visitors, for the capture index
+                    i.motion_score = sum(v.pixels for v in visitors) / SNAPSHOT_PIXELS
+                    print("\r{:6} {:2} blobs {:5.1f} fps {} dropped".format(session.frame_counter, len(blobs),
+                                                               session.fps(), event_writer.dropped), end="")
+                    if pyramid:
+                        print(" coarse {coarse:.1f} ms fine {fine:.1f} ms".format(**background_queue.level_times()),
+                              end="")
+                    sys.stdout.flush()
+                    if visitors:
+                        # save the full-sized images to files
+                        timings.increment("events")
+                        # every picture saved for this event is indexed under one id
+                        event_id += 1
+                        for picture in image_queue:
+                            picture.event_id = event_id
+                        with timings.timed("event"):
+                            background_queue, image_queue, event_counter = do_event(background_queue,
+                                                                                    image_queue,
+                                                                                    event_counter,
+                                                                                    event_writer)
+                    # If the image is very dark, then switch to darkness mode, pause for a few
+                    # minutes between taking thumbnails to save power
+                    if (session.frame_counter % HEARTBEAT == 0) or darkness.too_dark:
+                        with timings.timed("brightness"):
+                            light_level = light.level_of(m)
+                        i.brightness = light_level
+                        sleep_time = darkness.check(light_level)
+                        if sleep_time:
+                            print("\r{:6} sleeping {}s (too dark, light level {:.1f})".format(session.frame_counter,
+                                    sleep_time, light_level), end="")
+                            sys.stdout.flush()
+                            break
+                    with timings.timed("update"):
+                        background_queue.append(m)
+                    frame_start = timeit.default_timer()
+                else:
+                    # the stream has ended
+                    return
+            # The camera is closed while it is too dark, rather than left
+            # streaming to nobody; subscribing again opens it. Pictures of
+            # the last event are saved and indexed before the night.
+            engine.stop()
+            event_writer.flush()
+            index.flush()
+            with timings.timed("sleep"):
+                time.sleep(sleep_time)
+            print("\r{:70}".format(""), end="\r")
 
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Save pictures of whatever moves.")
+    parser.add_argument("--scene", choices=sorted(capture.SCENES),
+                        help="use a synthetic scene instead of the camera")
+    args = parser.parse_args()
+    run(capture.SyntheticBackend((_image_width, _image_height), **capture.SCENES[args.scene])
+        if args.scene else None)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The live preview for the web servers. The capture loops run in other
+# processes and keep replacing preview.jpg on the ramdisk; one thread in the
+# server notices each new preview, reads it once and hands it to every
+# viewer watching the MJPEG (multipart/x-mixed-replace) stream. The same
+# bytes answer every request for preview.jpg, with an ETag so that viewers
+# which already have the latest preview get 304 Not Modified.
+#
+# State, Preview and LivePreview are the CherryPy handlers that server.py
+# and timelapse_server.py both mount for these.
+#
+# python previews.py URL [--clients N] [--seconds S] [--conditional]
+# measures how many requests a second a server answers for URL.
+
+
+import argparse
+import email.utils
+import json
+import os
+import socket
+import threading
+import time
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    import cherrypy
+except ImportError:
+    cherrypy = None
+
+import storage
+
+
+PREVIEW_PATH = "/mnt/ramdisk/previews/preview.jpg"
+POLL_INTERVAL = 0.1 # how often to look for a new preview (in seconds)
+MAX_FPS = 2 # most previews sent to one viewer each second
+BOUNDARY = "cloudberrypreview"
+CONTENT_TYPE = "multipart/x-mixed-replace; boundary=" + BOUNDARY
+STATE_TTL = 1 # seconds /api/state is reused for
+
+
+class PreviewWatcher:
+    """The latest preview.jpg, read once each time it changes.
+
+    Every new preview gets the next generation number, so viewers can wait
+    for one newer than the last they were sent and never get a preview
+    twice. A preview that is still being written (without the jpeg end
+    marker yet) is skipped until the next poll.
+    """
+    def __init__(self, path=PREVIEW_PATH, poll_interval=POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.changed = threading.Condition()
+        self.data = None
+        self.generation = 0
+        self.modified = None
+        # ETags stay unique across server restarts, when generations start over
+        self.started = int(time.time())
+        self.running = False
+        self._stat = None
+        self._thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.changed:
+            self.changed.notify_all()
+
+    def _watch(self):
+        while self.running:
+            self.check()
+            time.sleep(self.poll_interval)
+
+    def check(self):
+        "Read preview.jpg if it has changed since it was last read."
+        try:
+            s = os.stat(self.path)
+            stat = (s.st_ino, s.st_size, s.st_mtime)
+            if stat == self._stat:
+                return
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return
+        if not data.endswith(b"\xff\xd9"):
+            return
+        self._stat = stat
+        with self.changed:
+            self.data = data
+            self.modified = int(s.st_mtime)
+            self.generation += 1
+            self.changed.notify_all()
+
+    def latest(self):
+        "(generation, jpeg data) of the latest preview; data is None before the first."
+        with self.changed:
+            return (self.generation, self.data)
+
+    def cached(self):
+        "(ETag, Last-Modified, jpeg data) of the latest preview; data is None before the first."
+        with self.changed:
+            generation, data, modified = self.generation, self.data, self.modified
+        if data is None:
+            return (None, None, None)
+        return (etag(self.started, generation), email.utils.formatdate(modified, usegmt=True), data)
+
+    def wait(self, generation, timeout=None):
+        """(generation, jpeg data) of the first preview newer than generation,
+        or of the latest one if none came within timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while self.running and self.generation <= generation:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+            return (self.generation, self.data)
+
+
+def etag(started, generation):
+    return '"{:x}-{}"'.format(started, generation)
+
+
+def not_modified(etag, last_modified, if_none_match=None, if_modified_since=None):
+    """Whether a GET with these If-None-Match and If-Modified-Since headers
+    can be answered 304 Not Modified. If-Modified-Since only counts without
+    If-None-Match, since previews can change more than once a second."""
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or ("W/" + etag) in tags
+    if if_modified_since is not None:
+        since = email.utils.parsedate_tz(if_modified_since)
+        modified = email.utils.parsedate_tz(last_modified)
+        return since is not None and email.utils.mktime_tz(modified) <= email.utils.mktime_tz(since)
+    return False
+
+
+def mjpeg(watcher, max_fps=MAX_FPS):
+    """The parts of a multipart/x-mixed-replace stream of previews, for as
+    long as the watcher runs.
+
+    Each viewer is sent at most max_fps previews a second, and always the
+    latest: a slow viewer skips the previews that came while it was still
+    receiving the last one instead of falling further behind.
+    """
+    sent_generation = 0
+    while watcher.running:
+        generation, data = watcher.wait(sent_generation, timeout=1)
+        if generation == sent_generation:
+            continue
+        sent = time.time()
+        yield ("--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n".format(
+            BOUNDARY, len(data))).encode("ascii") + data + b"\r\n"
+        sent_generation = generation
+        wait_time = 1 / max_fps - (time.time() - sent)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class State:
+    """Hostname, free space, camera status and the preview's generation in
+    one response, made at most once every ttl seconds however many viewers
+    ask."""
+    exposed = True
+
+    def __init__(self, watcher, camera_status=None, ttl=STATE_TTL):
+        self.watcher = watcher
+        self.camera_status = camera_status
+        self.ttl = ttl
+        self.hostname = socket.gethostname()
+        self.lock = threading.Lock()
+        self.body = None
+        self.expires = 0
+
+    def GET(self):
+        with self.lock:
+            now = time.time()
+            if now >= self.expires:
+                status = ""
+                if self.camera_status is not None:
+                    status = self.camera_status.status().get("text", "")
+                self.body = json.dumps({"hostname": self.hostname,
+                                        "freespace": storage.disk_free() / 1.0e9, # in gigabytes
+                                        "status": status,
+                                        "preview": self.watcher.latest()[0]}).encode("utf-8")
+                self.expires = now + self.ttl
+            body = self.body
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return body
+
+
+class Preview:
+    "preview.jpg from memory, or 304 Not Modified if the viewer has the latest already."
+    exposed = True
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def GET(self, *args, **kwargs):
+        etag, last_modified, data = self.watcher.cached()
+        if data is None:
+            raise cherrypy.NotFound()
+        headers = cherrypy.response.headers
+        headers['ETag'] = etag
+        headers['Last-Modified'] = last_modified
+        # browsers may keep it, but must ask whether it is still the latest
+        headers['Cache-Control'] = 'no-cache'
+        if not_modified(etag, last_modified,
+                        cherrypy.request.headers.get('If-None-Match'),
+                        cherrypy.request.headers.get('If-Modified-Since')):
+            cherrypy.response.status = 304
+            return b""
+        headers['Content-Type'] = 'image/jpeg'
+        return data
+
+
+class LivePreview:
+    "The preview as an MJPEG stream, pushed to the viewer as soon as it changes."
+    exposed = True
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def GET(self):
+        cherrypy.response.headers['Content-Type'] = CONTENT_TYPE
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return mjpeg(self.watcher)
+
+
+def load_test(url, clients=10, seconds=10, conditional=False):
+    """Requests a second answered for url by `clients` threads asking one
+    after another, each over its own keep-alive connection. With
+    conditional, every request after the first carries the last ETag."""
+    parts = urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    counts = [0] * clients
+    statuses = {}
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def client(i):
+        connection = httplib.HTTPConnection(parts.hostname, parts.port or 80)
+        tag = None
+        while time.time() < deadline:
+            headers = {"If-None-Match": tag} if conditional and tag else {}
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            tag = response.getheader("ETag") or tag
+            with lock:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            counts[i] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (sum(counts) / seconds, statuses)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Requests a second a server answers for a URL.")
+    parser.add_argument("url", nargs="?", default="http://localhost:8080/previews/preview.jpg")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--conditional", action="store_true",
+                        help="send If-None-Match with the last ETag, like a browser revalidating")
+    args = parser.parse_args()
+    rate, statuses = load_test(args.url, args.clients, args.seconds, args.conditional)
+    print("{:.1f} requests/s from {} clients, responses: {}".format(
+        rate, args.clients, ", ".join("{} x{}".format(s, n) for s, n in sorted(statuses.items()))))
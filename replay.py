@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run the motion detection pipeline on recorded pictures (or a made up
+# scene) as fast as it will go, and report how long each stage takes.
+#
+#   python replay.py [directory of jpegs] [--frames N] [--scene NAME]
+#                    [--output results.json]
+#                    [--full-decode] [--model window|mixture] [--pyramid]
+#                    [--budget-ms MS]
+
+
+import argparse
+import collections
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+from PIL import Image
+
+import capture
+import motion
+import writer
+
+
+class Timings:
+    "Latencies of each pipeline stage, in seconds."
+    def __init__(self):
+        self.samples = collections.OrderedDict()
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def timed(self, stage, f, *args):
+        start = timeit.default_timer()
+        result = f(*args)
+        self.record(stage, timeit.default_timer() - start)
+        return result
+
+    def summary(self):
+        stages = collections.OrderedDict()
+        for stage, xs in self.samples.items():
+            ms = np.asarray(xs) * 1000
+            stages[stage] = {"count": len(xs),
+                             "mean_ms": float(ms.mean()),
+                             "p50_ms": float(np.percentile(ms, 50)),
+                             "p95_ms": float(np.percentile(ms, 95)),
+                             "p99_ms": float(np.percentile(ms, 99))}
+        return stages
+
+
+def directory_pictures(directory):
+    "Pictures from a directory of jpegs, oldest (by name) first."
+    for f in sorted(os.listdir(directory)):
+        if os.path.splitext(f)[-1].lower() in (".jpg", ".jpeg"):
+            with open(os.path.join(directory, f), "rb") as jpeg:
+                data = jpeg.read()
+            yield motion.Picture(None, datetime.datetime.now(), data=data)
+
+
+def scripted_pictures(frames, size=(motion._image_width, motion._image_height), seed=0):
+    """A still scene in which a small dark square crosses the picture every
+    100 frames. The jpegs are made up front so that making them isn't
+    counted as part of the pipeline."""
+    rng = np.random.RandomState(seed)
+    background = Image.fromarray(rng.randint(60, 200, (size[1], size[0], 3)).astype(np.uint8))
+    side = size[0] // 40
+    steps = 40
+    scene = []
+    for step in range(steps + 1):
+        im = background.copy()
+        if step < steps:
+            x = step * (size[0] - side) // steps
+            y = size[1] // 2
+            im.paste((20, 20, 20), (x, y, x + side, y + side))
+        data = io.BytesIO()
+        im.save(data, format="JPEG", quality=90)
+        scene.append(data.getvalue())
+    return (motion.Picture(None, datetime.datetime.now(), data=scene[min(i % 100, steps)])
+            for i in range(frames))
+
+
+def synthetic_pictures(scene, frames, size=(motion._image_width, motion._image_height), seed=0):
+    "Pictures of one of capture.SCENES, also made up front."
+    backend = capture.SyntheticBackend(size, seed=seed, **capture.SCENES[scene])
+    return [motion.Picture(None, timestamp, data=data) for data, timestamp in backend.burst(frames)]
+
+
+def replay(pictures, output_directory, timings, background):
+    "Push pictures through the detection pipeline; returns (frames, events)."
+    motion._event_directory = os.path.join(output_directory, "events")
+    motion._preview_directory = os.path.join(output_directory, "previews")
+    os.makedirs(motion._event_directory)
+    os.makedirs(motion._preview_directory)
+
+    def save(*args):
+        timings.timed("write", motion.save_picture, *args)
+
+    frames = 0
+    events = 0
+    with writer.BackgroundWriter(save, policy=writer.BLOCK) as event_writer:
+        pictures = iter(pictures)
+        while True:
+            picture = timings.timed("load", next, pictures, None)
+            if picture is None:
+                break
+            frames += 1
+            m = timings.timed("preprocess", motion.preprocess_image, picture)
+            if len(background) == background.size:
+                visitors, blobs = timings.timed("detect", motion.find_visitors,
+                                                background, m, motion.SIGMA)
+                if visitors:
+                    background, queue, events = timings.timed("event", motion.do_event, background,
+                                                              collections.deque([picture]), events,
+                                                              event_writer)
+            timings.timed("update", background.append, m)
+    return (frames, events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the motion pipeline offline.")
+    parser.add_argument("directory", nargs="?", help="directory of jpegs (default: a scripted scene)")
+    parser.add_argument("--frames", type=int, default=300, help="frames in the scripted scene")
+    parser.add_argument("--scene", choices=sorted(capture.SCENES),
+                        help="use a synthetic scene instead of the scripted one")
+    parser.add_argument("--output", default="replay_results.json", help="where to write the results")
+    parser.add_argument("--full-decode", action="store_true",
+                        help="decode every pixel of each jpeg for detection (the old way)")
+    parser.add_argument("--model", default=motion.BACKGROUND_MODEL,
+                        choices=sorted(motion.BACKGROUND_MODELS),
+                        help="background model to detect with")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="detect coarse to fine, with early exit")
+    parser.add_argument("--budget-ms", type=float, default=200,
+                        help="time allowed to detect and update per frame (p95)")
+    args = parser.parse_args()
+    motion.DRAFT_DECODE = not args.full_decode
+
+    if args.directory:
+        pictures = directory_pictures(args.directory)
+    elif args.scene:
+        pictures = synthetic_pictures(args.scene, args.frames)
+    else:
+        pictures = scripted_pictures(args.frames)
+
+    if args.pyramid:
+        background = motion.PyramidDetector(motion.BACKGROUND_QUEUE_SIZE, args.model)
+    else:
+        background = motion.BACKGROUND_MODELS[args.model](motion.BACKGROUND_QUEUE_SIZE)
+    timings = Timings()
+    output_directory = tempfile.mkdtemp()
+    try:
+        start = timeit.default_timer()
+        frames, events = replay(pictures, output_directory, timings, background)
+        elapsed = timeit.default_timer() - start
+    finally:
+        shutil.rmtree(output_directory)
+
+    results = {"source": args.directory or args.scene or "scripted",
+               "draft_decode": motion.DRAFT_DECODE,
+               "model": args.model,
+               "pyramid": args.pyramid,
+               "frames": frames,
+               "events": events,
+               "seconds": elapsed,
+               "fps": frames / elapsed,
+               "stages": timings.summary()}
+    stages = results["stages"]
+    if args.pyramid:
+        results["levels"] = {"frames": background.frames, "cpu_ms_per_frame": background.level_times()}
+    if "detect" in stages:
+        frame_ms = stages["detect"]["p95_ms"] + stages["update"]["p95_ms"]
+        results["budget_ms"] = args.budget_ms
+        results["within_budget"] = frame_ms <= args.budget_ms
+    print("\n{} frames, {} events, {:.1f} fps".format(frames, events, results["fps"]))
+    if "budget_ms" in results:
+        print("{} model: detect + update p95 {:.2f} ms, budget {:.0f} ms ({})".format(
+            args.model, frame_ms, args.budget_ms,
+            "ok" if results["within_budget"] else "over budget"))
+    if args.pyramid:
+        print("pyramid: {} of {} frames went past the coarse level; cpu ms per frame: "
+              "coarse {coarse:.2f} fine {fine:.2f}".format(background.frames["fine"],
+                                                         background.frames["coarse"],
+                                                         **background.level_times()))
+    print("{:12} {:>8} {:>8} {:>8} {:>8}".format("stage", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for stage, s in results["stages"].items():
+        print("{:12} {:8d} {:8.2f} {:8.2f} {:8.2f}".format(stage, s["count"], s["p50_ms"],
+                                                           s["p95_ms"], s["p99_ms"]))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
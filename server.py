@@ -17,6 +17,7 @@ from __future__ import division, print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import datetime
 import json
 import os
 import os.path
@@ -25,8 +26,14 @@ import socket
 import cherrypy
 from cherrypy.lib.static import serve_file
 
+import metrics
+import previews
+import storage
+
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
+_previews = previews.PreviewWatcher()
+_index = storage.IndexReader(os.path.join(current_dir, "captures.db"))
 
 
 class Root:
@@ -60,6 +67,57 @@ cherrypy.tree.mount(Hostname(),
                     {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
 
 
+class Metrics:
+    exposed = True
+    def GET(self, format="json"):
+        programs = metrics.read_all()
+        if format == "prometheus":
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+            return metrics.prometheus(programs)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({"hostname": socket.gethostname(), "programs": programs}).encode("utf-8")
+
+cherrypy.tree.mount(Metrics(),
+                    '/api/metrics',
+                    {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+
+
+cherrypy.tree.mount(previews.State(_previews),
+                    '/api/state',
+                    {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+
+
+class Captures:
+    """Captures taken between start and end (like 2015-06-01T12:00:00),
+    looked up in the capture index."""
+    exposed = True
+    def GET(self, start=None, end=None, kind=None, event=None, limit=None):
+        try:
+            start = start and datetime.datetime.strptime(start, "%Y-%m-%dT%H:%M:%S")
+            end = end and datetime.datetime.strptime(end, "%Y-%m-%dT%H:%M:%S")
+            event = event and int(event)
+            limit = limit and int(limit)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        captures = _index.query(start, end, kind, event, limit)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps([dict(c._asdict(), timestamp=c.timestamp.isoformat())
+                           for c in captures]).encode("utf-8")
+
+cherrypy.tree.mount(Captures(),
+                    '/api/captures',
+                    {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+
+
+cherrypy.tree.mount(previews.Preview(_previews),
+                    '/previews/preview.jpg',
+                    {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+cherrypy.tree.mount(previews.LivePreview(_previews),
+                    '/api/preview.mjpeg',
+                    {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+                           'response.stream': True}})
+
+
 
 
 def run(testing=False):
@@ -72,6 +130,10 @@ def run(testing=False):
             '/static': {'tools.staticdir.on': True,
                     'tools.staticdir.dir': os.path.join(current_dir, 'static')}}
     cherrypy.server.socket_host = '0.0.0.0'
+    # every viewer watching the live preview keeps a thread for itself
+    cherrypy.server.thread_pool = 30
+    cherrypy.engine.subscribe('start', _previews.start)
+    cherrypy.engine.subscribe('stop', _previews.stop)
     #cherrypy.server.socket_host = '::' # for Mac (uses IPV6)
 
 
@@ -1,58 +1,106 @@
-function getFreeSpace() {
-    var url = "/api/freespace";
+// Everything the page shows but the preview comes from /api/state, one
+// request per refresh.
+function getState(callback) {
     var client = new XMLHttpRequest();
-    client.open("GET", url, false);
-    client.setRequestHeader("Content-Type", "text/plain");
+    client.open("GET", "/api/state", true);
+    client.onload = function() {
+        if (client.status == 200) {
+            callback(JSON.parse(client.responseText));
+        }
+    };
     client.send();
-    var response = 0;
-    if (client.status == 200) {
-        response = JSON.parse(client.responseText);
-    }
-    return(response.toFixed(2) + " GB");
 }
 
 
-function getHostname() {
-    var url = "/api/hostname";
-    var client = new XMLHttpRequest();
-    client.open("GET", url, false);
-    client.setRequestHeader("Content-Type", "text/plain");
-    client.send();
-    var response = 0;
-    if (client.status == 200) {
-        response = JSON.parse(client.responseText);
-    }
-    return(response);
+// The preview is pushed by the server as an MJPEG stream; if the browser
+// can't show one, fall back to fetching preview.jpg whenever it changes.
+var streaming = true;
+
+function startStream() {
+  var pic = document.getElementById("previewpic");
+  pic.onerror = function() {
+    pic.onerror = null;
+    streaming = false;
+    refreshPreview();
+  };
+  pic.src = "/api/preview.mjpeg";
+  document.getElementById("piclink").href = "/previews/preview.jpg";
 }
 
 
-function getStatus() {
-    var url = "/api/status";
-    var client = new XMLHttpRequest();
-    client.open("GET", url, false);
-    client.setRequestHeader("Content-Type", "text/plain");
-    client.send();
-    var response = 0;
-    if (client.status == 200) {
-        response = JSON.parse(client.responseText);
+// preview.jpg always has the same address, so the browser can ask for it with
+// the ETag it already has and get 304 Not Modified when nothing changed.
+var previewTag = null;
+
+function refreshPreview() {
+  var client = new XMLHttpRequest();
+  client.open("GET", "/previews/preview.jpg", true);
+  client.responseType = "blob";
+  client.onload = function() {
+    var tag = client.getResponseHeader("ETag");
+    if (client.status == 200 && tag != previewTag) {
+      previewTag = tag;
+      var pic = document.getElementById("previewpic");
+      var old = pic.src;
+      pic.src = URL.createObjectURL(client.response);
+      if (old.indexOf("blob:") == 0) {
+        URL.revokeObjectURL(old);
+      }
     }
-    return(response);
+  };
+  client.send();
 }
 
 
+var cameraStatus = "";
+var freeSpace = "";
+var lastCapture = "";
+var statusPushed = false;
 
-function refresh() {
-  fn = "preview.jpg?" + new Date().getTime();
-  document.getElementById("piclink").href = "/previews/" + fn;
-  document.getElementById("previewpic").src = "/previews/" + fn;
-  document.getElementById("status").innerHTML = getStatus() + " free space:" + getFreeSpace();
+function showStatus() {
+  document.getElementById("status").innerHTML = cameraStatus + " free space:" + freeSpace +
+      lastCapture;
 }
 
-hostname = getHostname()
-document.getElementById("title").innerHTML = hostname + " cloudberry viewfinder";
-document.getElementById("hostname").innerHTML = getHostname();
+
+// With a camera process attached (timelapse.py) its status and new captures
+// are pushed as they happen; elsewhere /api/events is missing and the
+// EventSource just gives up.
+if (window.EventSource) {
+  var events = new EventSource("/api/events");
+  events.addEventListener("status", function(e) {
+    cameraStatus = JSON.parse(e.data).text;
+    statusPushed = true;
+    showStatus();
+  });
+  events.addEventListener("capture", function(e) {
+    lastCapture = " last picture: " + JSON.parse(e.data).timestamp.split("T")[1].split(".")[0];
+    showStatus();
+  });
+}
+
+
+var previewGeneration = null;
+
+function refresh() {
+  getState(function(state) {
+    document.title = state.hostname + " cloudberry viewfinder";
+    document.getElementById("hostname").innerHTML = state.hostname;
+    if (!statusPushed) {
+      cameraStatus = state.status;
+    }
+    freeSpace = state.freespace.toFixed(2) + " GB";
+    showStatus();
+    // without the stream, only fetch the preview once there is a new one
+    if (!streaming && state.preview != previewGeneration) {
+      previewGeneration = state.preview;
+      refreshPreview();
+    }
+  });
+}
 
 var refreshInterval = setInterval( "refresh()", 10 * 1000);
 
 //initial values on page load
+startStream();
 refresh();
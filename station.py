@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Motion detection, the timelapse and the web server's live preview, all
+# running off one camera session instead of taking turns with the camera.
+
+
+import argparse
+import os
+import threading
+
+import capture
+import motion
+import timelapse_camera
+import writer
+
+
+_preview_directory = "/mnt/ramdisk/previews"
+_preview_size = (864, 648)
+_preview_quality = 50
+_preview_every = 10 # frames, about every 2 seconds at 5 frames per second
+
+
+def preview(engine):
+    "Keep preview.jpg up to date with the shared stream."
+    if not os.path.exists(_preview_directory):
+        os.makedirs(_preview_directory)
+    path = os.path.join(_preview_directory, "preview.jpg")
+    with engine.subscribe(keep_jpeg=True, maxsize=1, policy=writer.DROP_OLDEST,
+                          every=_preview_every) as frames:
+        while True:
+            frame = frames.next_frame()
+            if frame is None:
+                return
+            # written whole and then renamed, so the server never sends half a picture
+            with open(path + ".new", "wb") as f:
+                f.write(frame.preview(_preview_size, _preview_quality))
+            os.rename(path + ".new", path)
+
+
+def run(backend=None):
+    if backend is None:
+        backend = capture.PiCameraBackend((motion._image_width, motion._image_height), flip=True)
+    with capture.CaptureEngine(backend) as engine:
+        threads = [threading.Thread(target=motion.run, kwargs={"engine": engine}),
+                   threading.Thread(target=timelapse_camera.run, kwargs={"engine": engine}),
+                   threading.Thread(target=preview, args=(engine,))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        # motion detection runs for as long as the camera does
+        while threads[0].is_alive():
+            threads[0].join(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Motion, timelapse and preview off one camera.")
+    parser.add_argument("--scene", choices=sorted(capture.SCENES),
+                        help="use a synthetic scene instead of the camera")
+    args = parser.parse_args()
+    run(capture.SyntheticBackend((motion._image_width, motion._image_height),
+                                 **capture.SCENES[args.scene]) if args.scene else None)
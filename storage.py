@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Keeps the disk from filling up, shared by camera.py, timelapse_camera.py
+# and video.py. Instead of stopping when the disk is nearly full, old files
+# are deleted to make room, following a list of retention policies:
+#
+#   PREVIEWS_FIRST   previews, oldest first
+#   THIN_TIMELAPSE   in timelapse days older than thin_after_days, every
+#                    picture but each thin_keep_every'th one
+#   OLDEST_FIRST     anything, oldest first
+#
+# Every policy is used up before the next one is tried.
+#
+# Captures are filed in one directory per hour (directory/YYYY-MM-DD/HH/)
+# rather than thousands to a directory, and recorded in an SQLite index
+# (CaptureIndex) so they can be looked up by time without listing
+# directories.
+
+
+import collections
+import datetime
+import os
+import sqlite3
+import threading
+import time
+
+
+PICTURE = "picture"
+PREVIEW = "preview"
+TIMELAPSE = "timelapse"
+MOVIE = "movie"
+
+PREVIEWS_FIRST = "previews-first"
+THIN_TIMELAPSE = "thin-timelapse"
+OLDEST_FIRST = "oldest-first"
+POLICIES = (PREVIEWS_FIRST, THIN_TIMELAPSE, OLDEST_FIRST)
+
+RESERVE = 0.5e9 # bytes always left free on the disk
+RESYNC_INTERVAL = 3600 # seconds between checks of the real free space
+INDEX_BATCH = 50 # index rows written per transaction
+INDEX_FLUSH_INTERVAL = 10 # longest a row waits to be written (in seconds), as long as more come
+
+
+def disk_free(path="/"):
+    "Free disk space in bytes."
+    s = os.statvfs(path)
+    return s.f_bavail * s.f_frsize
+
+
+StoredFile = collections.namedtuple("StoredFile", "path size mtime")
+
+
+class StorageManager:
+    """A running count of the free disk space, and room made on demand.
+
+    The free space is read from the disk once, and after that only changed
+    by the files recorded as written (record()) and the files deleted here,
+    with a real check every resync_interval seconds to catch anything else
+    writing to the disk. make_room() deletes files, following `policies`,
+    until the next write leaves at least `reserve` bytes free.
+    """
+    def __init__(self, directories, reserve=RESERVE, policies=POLICIES, thin_after_days=7,
+                 thin_keep_every=6, path="/", resync_interval=RESYNC_INTERVAL, index=None):
+        for policy in policies:
+            if policy not in POLICIES:
+                raise ValueError("unknown retention policy: {}".format(policy))
+        self.reserve = reserve
+        self.policies = policies
+        self.thin_after_days = thin_after_days
+        self.thin_keep_every = thin_keep_every
+        self.path = path
+        self.resync_interval = resync_interval
+        self.index = index # a CaptureIndex to drop deleted files from
+        self.files = {} # kind -> deque of StoredFiles, oldest first
+        self.sizes = {} # path -> (kind, bytes)
+        self.thinned_days = set()
+        self.protected = set()
+        self.deleted = 0
+        for kind, directory in directories.items():
+            self._scan(kind, directory)
+        self.resync()
+
+    def _scan(self, kind, directory):
+        found = []
+        for root, dirs, files in os.walk(directory):
+            for f in files:
+                p = os.path.join(root, f)
+                s = os.stat(p)
+                found.append(StoredFile(p, s.st_size, s.st_mtime))
+        found.sort(key=lambda f: (f.mtime, f.path))
+        self.files[kind] = collections.deque(found)
+        for f in found:
+            self.sizes[f.path] = (kind, f.size)
+
+    def resync(self):
+        self.free = disk_free(self.path)
+        self.last_sync = time.time()
+
+    def record(self, path, kind, size=None):
+        """Account for a file that was just written, or has grown since it
+        was last recorded (like a video that is still being recorded)."""
+        if size is None:
+            size = os.path.getsize(path)
+        if path in self.sizes:
+            self.free -= size - self.sizes[path][1]
+            files = self.files[kind]
+            if files and files[-1].path == path:
+                files[-1] = files[-1]._replace(size=size)
+        else:
+            self.free -= size
+            self.files.setdefault(kind, collections.deque()).append(
+                StoredFile(path, size, time.time()))
+        self.sizes[path] = (kind, size)
+
+    def protect(self, path):
+        "Never delete path (like the file being recorded to)."
+        self.protected.add(path)
+
+    def unprotect(self, path):
+        self.protected.discard(path)
+
+    def _delete(self, f, kind):
+        try:
+            os.remove(f.path)
+        except OSError:
+            pass
+        else:
+            self.free += f.size
+            self.deleted += 1
+        self.sizes.pop(f.path, None)
+        if self.index is not None and kind != PREVIEW:
+            self.index.remove(f.path)
+
+    def _oldest(self, kinds):
+        "The oldest unprotected file of the given kinds, taken off its deque."
+        candidates = []
+        for kind in kinds:
+            for f in self.files.get(kind, ()):
+                if f.path not in self.protected:
+                    candidates.append((f.mtime, kind, f))
+                    break
+        if not candidates:
+            return None
+        mtime, kind, f = min(candidates, key=lambda c: c[0])
+        self.files[kind].remove(f)
+        return (f, kind)
+
+    def _thin(self, needed):
+        "Thin out old timelapse days until needed bytes are free."
+        files = self.files.get(TIMELAPSE)
+        if not files:
+            return
+        cutoff = datetime.date.today() - datetime.timedelta(days=self.thin_after_days)
+        days = collections.OrderedDict()
+        for f in files:
+            day = datetime.date.fromtimestamp(f.mtime)
+            if day < cutoff and day not in self.thinned_days:
+                days.setdefault(day, []).append(f)
+        for day, day_files in days.items():
+            for i, f in enumerate(day_files):
+                if i % self.thin_keep_every != 0 and f.path not in self.protected:
+                    files.remove(f)
+                    self._delete(f, TIMELAPSE)
+            self.thinned_days.add(day)
+            if self.free - needed >= self.reserve:
+                return
+
+    def make_room(self, nbytes=0):
+        """Delete files until writing nbytes more leaves the reserve free.
+        Returns False if there was nothing left that could be deleted."""
+        if time.time() - self.last_sync > self.resync_interval:
+            self.resync()
+        for policy in self.policies:
+            if self.free - nbytes >= self.reserve:
+                return True
+            if policy == THIN_TIMELAPSE:
+                self._thin(nbytes)
+                continue
+            kinds = [PREVIEW] if policy == PREVIEWS_FIRST else list(self.files)
+            while self.free - nbytes < self.reserve:
+                oldest = self._oldest(kinds)
+                if oldest is None:
+                    break
+                self._delete(*oldest)
+        return self.free - nbytes >= self.reserve
+
+
+def shard_directory(directory, timestamp):
+    "directory/YYYY-MM-DD/HH for a capture taken at timestamp, made if need be."
+    path = os.path.join(directory, timestamp.strftime("%Y-%m-%d"), timestamp.strftime("%H"))
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # another process (a save worker) made it first
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
+Capture = collections.namedtuple("Capture",
+                                 "path kind timestamp size brightness motion_score event_id preview")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    path TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    size INTEGER NOT NULL,
+    brightness REAL,
+    motion_score REAL,
+    event_id INTEGER,
+    preview TEXT
+);
+CREATE INDEX IF NOT EXISTS captures_timestamp ON captures (timestamp);
+CREATE INDEX IF NOT EXISTS captures_event_id ON captures (event_id);
+"""
+
+
+def _seconds(timestamp):
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+
+class CaptureIndex:
+    """An SQLite index of every capture: path, kind, time, size, brightness,
+    motion score, event id and preview path.
+
+    Rows are written in batches of `batch` (or when the oldest has waited
+    flush_interval seconds), each batch in one transaction, so indexing
+    doesn't add a disk sync to every picture. The database is in WAL mode,
+    so the web server can read it while the capture loop writes.
+
+    Without create, the index is opened read-only, as the web servers do:
+    the schema is left alone, and sqlite3.OperationalError is raised rather
+    than an empty database made when the capture loop hasn't made one yet.
+    """
+    def __init__(self, path, batch=INDEX_BATCH, flush_interval=INDEX_FLUSH_INTERVAL,
+                 create=True):
+        self.path = path
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        if create:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.executescript(_SCHEMA)
+        else:
+            # connecting would make an empty database, so check first
+            if not os.path.exists(path):
+                raise sqlite3.OperationalError("no capture index at {}".format(path))
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute("PRAGMA query_only = ON")
+        self.added = []
+        self.removed = []
+        self.last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, path, timestamp, size, kind=PICTURE, brightness=None, motion_score=None,
+            event_id=None, preview=None):
+        with self.lock:
+            self.added.append((path, kind, _seconds(timestamp), size, brightness, motion_score,
+                               event_id, preview))
+            self._maybe_flush()
+
+    def remove(self, path):
+        with self.lock:
+            self.removed.append((path,))
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (len(self.added) + len(self.removed) >= self.batch
+                or time.time() - self.last_flush > self.flush_interval):
+            self._flush()
+
+    def _flush(self):
+        if self.added or self.removed:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                            self.added)
+                self.connection.executemany("DELETE FROM captures WHERE path = ?", self.removed)
+        self.added = []
+        self.removed = []
+        self.last_flush = time.time()
+
+    def flush(self):
+        "Write everything waiting in the batch now."
+        with self.lock:
+            self._flush()
+
+    def query(self, start=None, end=None, kind=None, event_id=None, limit=None):
+        "Captures taken from start up to (not including) end, oldest first."
+        where, args = [], []
+        if start is not None:
+            where.append("timestamp >= ?")
+            args.append(_seconds(start))
+        if end is not None:
+            where.append("timestamp < ?")
+            args.append(_seconds(end))
+        if kind is not None:
+            where.append("kind = ?")
+            args.append(kind)
+        if event_id is not None:
+            where.append("event_id = ?")
+            args.append(event_id)
+        sql = "SELECT * FROM captures"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY timestamp"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self.lock:
+            self._flush()
+            rows = self.connection.execute(sql, args).fetchall()
+        return [Capture(r[0], r[1], datetime.datetime.fromtimestamp(r[2]), *r[3:]) for r in rows]
+
+    def last_event_id(self):
+        "The highest event id in the index, 0 if there are none."
+        with self.lock:
+            self._flush()
+            row = self.connection.execute("SELECT MAX(event_id) FROM captures").fetchone()
+        return row[0] or 0
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.connection.close()
+
+
+class IndexReader:
+    """Read-only connections to the capture index, one per thread, for the
+    web servers to look captures up without opening the index on every
+    request."""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def query(self, *args, **kwargs):
+        "Like CaptureIndex.query(); [] until the capture loop has made the index."
+        index = getattr(self.local, "index", None)
+        if index is None:
+            try:
+                index = CaptureIndex(self.path, create=False)
+            except sqlite3.OperationalError:
+                return []
+            self.local.index = index
+        return index.query(*args, **kwargs)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The running BackgroundModel must find the same foreground as computing the
+# statistics over the whole window with calc_stats, the way motion.py used
+# to, and the PyramidDetector must leave frames with nothing but sensor
+# noise at its coarse level. Run with `python -m pytest test_motion.py` or
+# `python test_motion.py`.
+
+
+import unittest
+
+import numpy as np
+
+import capture
+import motion
+
+
+WINDOW = 60
+FRAMES = 100 # more than WINDOW, so frames also leave the running sums
+
+
+def synthetic_frames(scene, count=FRAMES):
+    "count seeded detection sized luma frames of one of capture.SCENES."
+    backend = capture.SyntheticBackend(**capture.SCENES[scene])
+    frames = backend.frames((motion.SNAPSHOT_SHAPE[1], motion.SNAPSHOT_SHAPE[0]))
+    return [next(frames)[0] for x in range(count)]
+
+
+def calc_stats_foreground(window, x, factor):
+    """(pixels in x more than factor standard deviations from the mean of
+    window, pixels too close to the threshold to call either way)."""
+    mean, stdev = motion.calc_stats(window)
+    deviation = np.abs(x - mean)
+    threshold = factor * stdev
+    # calc_stats works in floating point, so a pixel sitting exactly on the
+    # threshold can come out on either side of it
+    undecided = np.isclose(deviation, threshold, rtol=1e-9, atol=1e-9)
+    return (deviation > threshold, undecided)
+
+
+class BackgroundModelTest(unittest.TestCase):
+    def check_scene(self, scene, factors=(motion.SIGMA, 2, 1)):
+        frames = synthetic_frames(scene)
+        model = motion.BackgroundModel(WINDOW)
+        checked = 0
+        for i, x in enumerate(frames):
+            if len(model) == WINDOW:
+                window = frames[i - WINDOW:i]
+                for factor in factors:
+                    expected, undecided = calc_stats_foreground(window, x, factor)
+                    mask = model.foreground_mask(x, factor)
+                    self.assertTrue(np.array_equal(mask[~undecided], expected[~undecided]),
+                                    "{} frame {} factor {}".format(scene, i, factor))
+                    count = model.foreground(x, factor)
+                    self.assertLessEqual(abs(count - np.count_nonzero(expected)),
+                                         np.count_nonzero(undecided))
+                checked += 1
+            model.append(x)
+        self.assertEqual(checked, FRAMES - WINDOW)
+
+    def test_static(self):
+        # no noise at all: the standard deviation is 0 everywhere
+        self.check_scene("static")
+
+    def test_noise(self):
+        self.check_scene("noise")
+
+    def test_visitors(self):
+        self.check_scene("visitors")
+
+    def test_ramp(self):
+        self.check_scene("ramp")
+
+    def test_finds_visitors(self):
+        # not a vacuous agreement: the visitors scene has foreground to find
+        frames = synthetic_frames("visitors")
+        model = motion.BackgroundModel(WINDOW)
+        counts = []
+        for x in frames:
+            if len(model) == WINDOW:
+                counts.append(model.foreground(x, motion.SIGMA))
+            model.append(x)
+        self.assertGreater(max(counts), 0)
+
+
+class PyramidDetectorTest(unittest.TestCase):
+    def detect(self, scene):
+        "(PyramidDetector after a scene, frames in which it found visitors)."
+        detector = motion.PyramidDetector(WINDOW)
+        found = 0
+        for x in synthetic_frames(scene, WINDOW + 140):
+            if len(detector) == WINDOW:
+                visitors, blobs = motion.find_visitors(detector, x, motion.SIGMA)
+                found += bool(visitors)
+            detector.append(x)
+        return (detector, found)
+
+    def test_noise_stays_coarse(self):
+        detector, found = self.detect("noise")
+        self.assertEqual(detector.frames["coarse"], 140)
+        self.assertEqual(detector.frames["fine"], 0)
+        self.assertEqual(found, 0)
+
+    def test_finds_visitors(self):
+        detector, found = self.detect("visitors")
+        self.assertGreater(found, 0)
+        self.assertGreaterEqual(detector.frames["fine"], found)
+        self.assertLess(detector.frames["fine"], 140)
+
+
+if __name__ == "__main__":
+    unittest.main()
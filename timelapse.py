@@ -14,8 +14,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from multiprocessing import Process, Queue, Array
+from multiprocessing import Process, Queue
 
+import channel
 import timelapse_camera
 import timelapse_server
 
@@ -28,7 +29,7 @@ __version__ = "0"
 
 if __name__ == "__main__":
     print("cloudberry timelapse camera v{}".format(__version__))
-    camera_status = Array('c', 200)
+    camera_status = channel.StatusChannel()
     camera = Process(target=timelapse_camera.run, args=(camera_status,))
     server = Process(target=timelapse_server.run, args=(camera_status,))
     camera.start()
@@ -18,36 +18,32 @@ from __future__ import division, print_function
 
 
 import datetime
-import io
-import math
 import os
 import shutil
 import sys
 import time
 
-import numpy
-import picamera
-from PIL import Image
-
+import capture
+import channel
+import jpeg
+import light
+import metrics
+import storage
 
 
 _current_directory = os.path.dirname(os.path.abspath(__file__))
 _preview_directory =  "/mnt/ramdisk/previews"
 _picture_directory = _current_directory + "/pictures"
+_index_path = _current_directory + "/captures.db"
 _start_time = datetime.datetime.now()
 _image_width = 2592
 _image_height = 1944
 _preview_width = _image_width // 2
 _preview_heigh = _image_height // 2
 _timelapse_interval = 600 # how long to wait between taking pictures (in seconds)
-_darkness_cutoff = 18
-_darkness_sleeptime = 600 - _timelapse_interval # how long to wait when image is too dark (in seconds)
-
-
-def brightness(image):
-    m = numpy.asarray(image)
-    b = math.log(numpy.sum(m))
-    return b
+_darkness_min_sleeptime = _timelapse_interval # extra wait when image is too dark (in seconds),
+_darkness_max_sleeptime = 3600                 # doubling while it stays dark
+_idle_timeout = 60 # close the camera when not used for this long (in seconds)
 
 
 def ensure_directory(path):
@@ -55,80 +51,87 @@ def ensure_directory(path):
         os.makedirs(path)
 
 
-def free_space():
-    "Free disk space in gigabytes."
-    s = os.statvfs('/')
-    return (s.f_bavail * s.f_frsize) / 1.0e9
-
-
-def save_preview(image):
-    preview = image.resize((_preview_width,_preview_heigh))
+def save_preview(data):
+    preview = jpeg.preview(data, (_preview_width,_preview_heigh))
     preview.save(os.path.join(_preview_directory, "preview.jpg"), quality=30)
 
 
-def save_image(image, filepath):
-    image.save(filepath, quality=90)
+def save_image(data, filepath):
+    jpeg.save(data, filepath)
 
 
-def update_status(status, camera_status=None):
+def update_status(status, camera_status=None, **fields):
     print(status)
     if camera_status is not None:
-        # always append a null at the end to avoid run-on strings
-        camera_status[0:len(status)+1] = status + '\x00'
+        camera_status.publish(channel.STATUS, text=status, **fields)
 
 
-def run(camera_status=None):
+def run(camera_status=None, backend=None, engine=None):
     ensure_directory(_preview_directory)
     ensure_directory(_picture_directory)
     counter = 0
-    with picamera.PiCamera() as camera:
-        camera.resolution = (2592, 1944) #2592, 1944
-        camera.vflip = True
-        camera.hflip = True
-        camera.annotate_background = True
-        time.sleep(5)
+    darkness = light.DarknessMonitor(_darkness_min_sleeptime, _darkness_max_sleeptime)
+    # old days are thinned out, then deleted, to make room rather than
+    # stopping when the disk fills up
+    index = storage.CaptureIndex(_index_path)
+    disk = storage.StorageManager({storage.TIMELAPSE: _picture_directory}, index=index)
+    timings = metrics.Metrics("timelapse", ("capture", "brightness", "preview", "write", "sleep"),
+                              ("images",))
+    # The camera is closed between pictures that are further apart than
+    # _idle_timeout, and kept open (no settling delay) when they are closer.
+    # Given a shared engine, pictures come from its stream while that runs.
+    if engine is None:
+        if backend is None:
+            backend = capture.PiCameraBackend((_image_width, _image_height), flip=True, settle_time=5)
+        engine = capture.CaptureEngine(backend, _idle_timeout)
+    with index, engine as camera:
         start_time = datetime.datetime.now()
         next_time = start_time
-        try:
+        timestamp = datetime.datetime.now()
+        while True:
             timestamp = datetime.datetime.now()
-            while free_space() > 0.5:
-                timestamp = datetime.datetime.now()
-                next_time = next_time + datetime.timedelta(seconds=_timelapse_interval)
-                camera.annotate_text = timestamp.strftime("%Y-%m-%d %H:%M:%S").lower()
-                # Create the in-memory stream
-                stream = io.BytesIO()
-                camera.capture(stream, format='jpeg')
-                # "Rewind" the stream to the beginning so we can read its content
-                stream.seek(0)
-                image = Image.open(stream)
-                light_level = brightness(image)
-                save_preview(image)
-                status = ""
-                if light_level > _darkness_cutoff:
-                    save_location = os.path.join(_picture_directory, timestamp.strftime("%Y-%m-%d"))
-                    ensure_directory(save_location)
-                    fpath = os.path.join(save_location, "{:06d}.jpg".format(counter))
-                    save_image(image, fpath)
-                    counter = counter + 1
-                else:
-                    status += "[sleeping] "
-                    next_time = next_time + datetime.timedelta(seconds=_darkness_sleeptime)
-                stream.close()
-                # figure out how long to wait before taking next picture
-                if datetime.datetime.now() <= next_time:
-                    wait_time = next_time - datetime.datetime.now()
-                    wait_time = wait_time.seconds + wait_time.microseconds * 1e-6
-                else:
-                    # It could be that the time to take next picture has already passed.
-                    # In that case, wait time should be negative and value passed to
-                    # time.sleep() should be 0.
-                    wait_time = datetime.datetime.now() - next_time
-                    wait_time = -1 * (wait_time.seconds + wait_time.microseconds * 1e-6)
-                status += "run:{} images:{} wait:{:.2f}s brightness:{:.2f}".format(str(timestamp - start_time).split(".")[0], counter, wait_time, light_level)
-                update_status(status, camera_status)
+            next_time = next_time + datetime.timedelta(seconds=_timelapse_interval)
+            with timings.timed("capture"):
+                data, _ = camera.take_picture(timestamp.strftime("%Y-%m-%d %H:%M:%S").lower())
+            with timings.timed("brightness"):
+                light_level = light.level(data)
+            sleep_time = darkness.check(light_level)
+            with timings.timed("preview"):
+                save_preview(data)
+            status = ""
+            if not sleep_time:
+                save_location = storage.shard_directory(_picture_directory, timestamp)
+                fpath = os.path.join(save_location, "{:06d}.jpg".format(counter))
+                disk.make_room(len(data))
+                with timings.timed("write"):
+                    save_image(data, fpath)
+                disk.record(fpath, storage.TIMELAPSE, len(data))
+                index.add(fpath, timestamp, len(data), kind=storage.TIMELAPSE, brightness=light_level)
+                if camera_status is not None:
+                    camera_status.publish(channel.CAPTURE,
+                                          path=os.path.relpath(fpath, _picture_directory),
+                                          timestamp=timestamp.isoformat(), size=len(data),
+                                          brightness=light_level)
+                timings.increment("images")
+                counter = counter + 1
+            else:
+                status += "[sleeping] "
+                next_time = next_time + datetime.timedelta(seconds=sleep_time)
+            # figure out how long to wait before taking next picture
+            if datetime.datetime.now() <= next_time:
+                wait_time = next_time - datetime.datetime.now()
+                wait_time = wait_time.seconds + wait_time.microseconds * 1e-6
+            else:
+                # It could be that the time to take next picture has already passed.
+                # In that case, wait time should be negative and value passed to
+                # time.sleep() should be 0.
+                wait_time = datetime.datetime.now() - next_time
+                wait_time = -1 * (wait_time.seconds + wait_time.microseconds * 1e-6)
+            status += "run:{} images:{} wait:{:.2f}s light:{:.2f}".format(str(timestamp - start_time).split(".")[0], counter, wait_time, light_level)
+            update_status(status, camera_status, images=counter, light=light_level,
+                          sleeping=bool(sleep_time), wait=wait_time)
+            with timings.timed("sleep"):
                 time.sleep(0 if wait_time < 0 else wait_time)
-        finally:
-                camera.close()
 
 
 
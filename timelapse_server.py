@@ -17,6 +17,7 @@ from __future__ import division, print_function
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import datetime
 import json
 import os
 import os.path
@@ -25,9 +26,15 @@ import socket
 import cherrypy
 from cherrypy.lib.static import serve_file
 
+import channel
+import metrics
+import previews
+import storage
+
 
 _current_directory = os.path.dirname(os.path.abspath(__file__))
 _static_directory = _current_directory + "/static/"
+_index = storage.IndexReader(os.path.join(_current_directory, "captures.db"))
 
 
 class Root:
@@ -53,6 +60,35 @@ class Hostname:
         return json.dumps(hostname)
 
 
+class Metrics:
+    exposed = True
+    def GET(self, format="json"):
+        programs = metrics.read_all()
+        if format == "prometheus":
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+            return metrics.prometheus(programs)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps({"hostname": socket.gethostname(), "programs": programs}).encode("utf-8")
+
+
+class Captures:
+    """Captures taken between start and end (like 2015-06-01T12:00:00),
+    looked up in the capture index."""
+    exposed = True
+    def GET(self, start=None, end=None, kind=None, event=None, limit=None):
+        try:
+            start = start and datetime.datetime.strptime(start, "%Y-%m-%dT%H:%M:%S")
+            end = end and datetime.datetime.strptime(end, "%Y-%m-%dT%H:%M:%S")
+            event = event and int(event)
+            limit = limit and int(limit)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+        captures = _index.query(start, end, kind, event, limit)
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps([dict(c._asdict(), timestamp=c.timestamp.isoformat())
+                           for c in captures]).encode("utf-8")
+
+
 class Status:
     exposed = True
 
@@ -62,10 +98,29 @@ class Status:
     def GET(self):
         status = ""
         if self.camera_status is not None:
-            status = self.camera_status.value
+            status = self.camera_status.status().get("text", "")
         return json.dumps(status)
 
 
+class Events:
+    "The camera's status and new captures, pushed as Server-Sent Events."
+    exposed = True
+
+    def __init__(self, camera_status):
+        self.camera_status = camera_status
+
+    def GET(self):
+        if self.camera_status is None:
+            raise cherrypy.NotFound()
+        try:
+            last_event_id = int(cherrypy.request.headers['Last-Event-ID'])
+        except (KeyError, ValueError):
+            last_event_id = None
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return channel.server_sent_events(self.camera_status, last_event_id)
+
+
 
 
 def run(camera_status=None, testing=False):
@@ -76,8 +131,13 @@ def run(camera_status=None, testing=False):
     conf = {'/previews': {'tools.staticdir.on': True,
                     'tools.staticdir.dir': '/mnt/ramdisk/previews'},
             '/static': {'tools.staticdir.on': True,
-                    'tools.staticdir.dir': os.path.join(current_dir, 'static')}}
+                    'tools.staticdir.dir': _static_directory}}
     cherrypy.server.socket_host = '0.0.0.0'
+    # every viewer watching the live preview keeps a thread for itself
+    cherrypy.server.thread_pool = 30
+    watcher = previews.PreviewWatcher()
+    cherrypy.engine.subscribe('start', watcher.start)
+    cherrypy.engine.subscribe('stop', watcher.stop)
     #cherrypy.server.socket_host = '::' # for Mac (uses IPV6)
 
 
@@ -94,6 +154,26 @@ def run(camera_status=None, testing=False):
     cherrypy.tree.mount(Status(camera_status),
             '/api/status',
             {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+    cherrypy.tree.mount(Events(camera_status),
+            '/api/events',
+            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+                   'response.stream': True}})
+    cherrypy.tree.mount(previews.State(watcher, camera_status),
+            '/api/state',
+            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+    cherrypy.tree.mount(Metrics(),
+            '/api/metrics',
+            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+    cherrypy.tree.mount(Captures(),
+            '/api/captures',
+            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+    cherrypy.tree.mount(previews.Preview(watcher),
+            '/previews/preview.jpg',
+            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}})
+    cherrypy.tree.mount(previews.LivePreview(watcher),
+            '/api/preview.mjpeg',
+            {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
+                   'response.stream': True}})
 
     cherrypy.quickstart(Root(), '/', config=conf)
 
@@ -25,7 +25,9 @@ import shutil
 import sys
 import time
 
-import picamera
+import capture
+import metrics
+import storage
 
 
 _current_directory = os.path.dirname(os.path.abspath(__file__))
@@ -37,59 +39,72 @@ _preview_resolution = (960, 540)
 _framerate = 4 #frames per second
 _start_time = datetime.time(6)
 _end_time = datetime.time(18)
-_minimum_free_space = 0.5 #free space in GB
+_preview_interval = 15 # seconds
 
 
-def free_space():
-    "Free disk space in gigabytes."
-    s = os.statvfs('/')
-    return (s.f_bavail * s.f_frsize) / 1.0e9
-
-
-def run():
+def run(engine=None):
     if not os.path.exists(_preview_directory):
         os.makedirs(_preview_directory)
     if not os.path.exists(_movie_directory):
         os.makedirs(_movie_directory)
 
-    now = datetime.datetime.now().time()
-    while free_space() > _minimum_free_space:
+    # old movies are deleted to make room rather than stopping when the disk fills up
+    disk = storage.StorageManager({storage.MOVIE: _movie_directory})
+    timings = metrics.Metrics("video", ("preview", "record", "sleep"), ("previews", "movies"))
+    if engine is None:
+        backend = capture.PiCameraBackend(_resolution, framerate=_framerate, flip=True)
+        engine = capture.CaptureEngine(backend)
+    # the camera closes by itself overnight, once it is no longer recording
+    with engine as camera:
         now = datetime.datetime.now().time()
-        if now > _start_time and now < _end_time:
-            counter = 1
-            with picamera.PiCamera() as camera:
-                camera.resolution = _resolution
-                camera.vflip = True
-                camera.hflip = True
-                camera.framerate = _framerate
-                camera.annotate_background = True
+        while True:
+            now = datetime.datetime.now().time()
+            if now > _start_time and now < _end_time:
+                counter = 1
                 try:
                     start_time = datetime.datetime.now()
                     fn = os.path.join(_movie_directory, "{}.h264".format(start_time.strftime("%Y%b%d_%H-%M-%S").lower()))
                     print("\nrecording video to {}".format(fn))
+                    disk.protect(fn)
                     camera.start_recording(fn)
-                    while free_space() > _minimum_free_space and now > _start_time and now < _end_time:
+                    timings.increment("movies")
+                    size = 0
+                    while now > _start_time and now < _end_time:
                         timestamp = datetime.datetime.now()
                         now = timestamp.time()
-                        camera.annotate_text = timestamp.strftime("%Y%b%d %H:%M").lower()
-                        camera.capture(os.path.join(_preview_directory,"preview.jpg"),
-                                resize=_preview_resolution,
-                                quality=30,
-                                use_video_port=True)
+                        camera.annotate(timestamp.strftime("%Y%b%d %H:%M").lower())
+                        with timings.timed("preview"):
+                            data, _ = camera.take_preview(_preview_resolution, quality=30)
+                            with open(os.path.join(_preview_directory, "preview.jpg"), "wb") as f:
+                                f.write(data)
+                        timings.increment("previews")
                         print("\r{:78}".format(""), end="\r")
                         print("\rrunning:{} previews:{}".format(str(timestamp - start_time).split(".")[0], counter), end="")
                         sys.stdout.flush()
                         counter += 1
-                        camera.wait_recording(15)
+                        with timings.timed("record"):
+                            camera.wait_recording(_preview_interval)
+                        # expect the next interval to take as much room as the last one
+                        grown = os.path.getsize(fn) - size
+                        size += grown
+                        disk.record(fn, storage.MOVIE, size)
+                        if not disk.make_room(grown):
+                            # only this recording is left; start a new one so
+                            # that this one can go
+                            break
                 finally:
                     print()
                     camera.stop_recording()
-        else:
-            print("\r{:78}".format(""), end="\r")
-            print("\rsleeping until {} (current time is {})".format(str(_start_time), str(now).split(".")[0]), end="")
-            sys.stdout.flush()
-            shutil.copy(os.path.join(_static_directory, "sleeping.jpg"), os.path.join(_preview_directory, "preview.jpg"))
-            time.sleep(20)
+                    disk.unprotect(fn)
+                    if os.path.exists(fn):
+                        disk.record(fn, storage.MOVIE)
+            else:
+                print("\r{:78}".format(""), end="\r")
+                print("\rsleeping until {} (current time is {})".format(str(_start_time), str(now).split(".")[0]), end="")
+                sys.stdout.flush()
+                shutil.copy(os.path.join(_static_directory, "sleeping.jpg"), os.path.join(_preview_directory, "preview.jpg"))
+                with timings.timed("sleep"):
+                    time.sleep(20)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+
+# cloudberryCam v0 copyright (c) 2013-2015 Lars Rosengreen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+
+
+class BackgroundWriter:
+    """Runs a save function on worker threads so the capture loop doesn't
+    have to wait for pictures to be resized, encoded and written.
+
+    At most `maxsize` jobs wait in the queue. When it is full, put() either
+    waits for a worker to catch up (BLOCK) or throws away the oldest waiting
+    job to make room (DROP_OLDEST). close() writes out everything still
+    queued before returning.
+    """
+    def __init__(self, save, maxsize=6, policy=BLOCK, workers=1):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError("unknown writer policy: {}".format(policy))
+        self.save = save
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        # the counts are updated from every worker thread
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.threads = [threading.Thread(target=self._work) for x in range(workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+                self.save(*job)
+                with self.lock:
+                    self.written += 1
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def put(self, *args):
+        if self.policy == BLOCK:
+            self.queue.put(args)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(args)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    with self.lock:
+                        self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self):
+        "Wait until every queued job has been written."
+        self.queue.join()
+
+    def close(self):
+        "Write everything still queued, then stop the workers."
+        self.flush()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()